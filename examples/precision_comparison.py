@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+# Include the directory up in the path:
+import sys
+sys.path.insert(0,'..')
+
+import time
+import numpy as np
+
+# Import stocker:
+import stocker
+
+# NumPy draws different random numbers in single and double precision, even
+# from the same seed. To compare the precisions on the same random returns,
+# this generator always draws in double precision and then converts the
+# draws to the precision of the simulation:
+class Double_Precision_Draws(object):
+  def __init__(self, seed):
+    self.rng = np.random.default_rng(seed)
+
+  def standard_normal(self, out, dtype):
+    out[...] = self.rng.standard_normal(out.shape)
+
+# Run a vectorized monte carlo simulation, returning its exact statistics and run time:
+def simulate(scenario, n, goal, seed, dtype):
+  mc = stocker.Monte_Carlo(scenario)
+  mc.rng = Double_Precision_Draws(seed)
+  start = time.time()
+  mc.run(n=n, vectorized=True, dtype=dtype)
+  elapsed = time.time() - start
+  values = np.array(mc.raw_values)
+  stats = {"goal": np.mean(values > goal), "mean": np.mean(values)}
+  for perc in [10, 50, 90]:
+    stats[perc] = np.percentile(values, perc)
+  return stats, elapsed
+
+# Main:
+if __name__== "__main__":
+  n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+  # Let's save in all 14 of the Morningstar asset classes for 30 years,
+  # contributing 10k annually with a 2% increase in that contribution annually.
+  positions = [
+    stocker.US_Large_Cap_Growth_Stocks(), stocker.US_Large_Cap_Value_Stocks(), stocker.US_Mid_Cap_Growth_Stocks(), \
+    stocker.US_Mid_Cap_Value_Stocks(), stocker.US_Small_Cap_Growth_Stocks(), stocker.US_Small_Cap_Value_Stocks(), \
+    stocker.International_Dev_Stocks(), stocker.International_Emrg_Stocks(), stocker.US_Investment_Grd_Bonds(), \
+    stocker.US_High_Yield_Bonds(), stocker.International_Dev_Bonds(), stocker.Three_Mon_Treasury_Bills(), \
+    stocker.Commodities(), stocker.US_Real_Estate()
+  ]
+  portfolio = stocker.Portfolio(name="Morningstar", value=50000.0, positions=positions, weights=[10, 10, 8, 8, 6, 6, 10, 6, 12, 6, 6, 4, 4, 4])
+  scenario = stocker.Scenario(name="Morningstar Accumulation", portfolio=portfolio, num_years=30, annual_contribution=10000, annual_contribution_increase_perc=2.0)
+  goal = 1000000
+
+  # Compare a single precision simulation to a double precision simulation on the
+  # same random returns, and to a second double precision simulation with a different
+  # seed to show the size of the sampling noise:
+  reference, reference_time = simulate(scenario, n, goal, seed=1, dtype="float64")
+  single, single_time = simulate(scenario, n, goal, seed=1, dtype="float32")
+  other, other_time = simulate(scenario, n, goal, seed=2, dtype="float64")
+
+  template = "{0:<20}|{1:>16}|{2:>16}|{3:>16}|{4:>18}"
+  print("Runs: " + str(n) + ", Positions: " + str(len(positions)) + ", Years: " + str(scenario.num_years))
+  print(template.format("Statistic", "float64", "float32", "float32 error", "float64 seed error"))
+  def row(name, get, format):
+    print(template.format(name, format(get(reference)), format(get(single)), format(get(single) - get(reference)), format(get(other) - get(reference))))
+  row("Goal Likelihood", lambda s: s["goal"], lambda v: "%0.3f%%" % (v*100.0))
+  for perc in [10, 50, 90]:
+    row(str(perc) + "th Perc", lambda s: s[perc], stocker._format_currency)
+  row("Average", lambda s: s["mean"], stocker._format_currency)
+  print("Run time: float64 %0.2fs, float32 %0.2fs" % (reference_time, single_time))
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# Include the directory up in the path:
+import sys
+sys.path.insert(0,'..')
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import time
+
+# Import stocker:
+import stocker
+
+# Load a job file and pull out the jobs to send to the server:
+def load_jobs():
+  return stocker.load_jobs(os.path.join(os.path.dirname(os.path.abspath(__file__)), "batch_jobs.json"))
+
+# Send a single job to the server and read the streamed events, returning
+# the time to the first progress event, the total latency and the final
+# result event:
+async def simulate(host, port, job):
+  start = time.time()
+  reader, writer = await asyncio.open_connection(host, port)
+  body = json.dumps(job).encode("utf-8")
+  writer.write(("POST /simulate HTTP/1.1\r\nHost: " + host + "\r\nContent-Type: application/json\r\nContent-Length: " + str(len(body)) + "\r\n\r\n").encode("latin-1") + body)
+  await writer.drain()
+
+  # Skip the response headers:
+  while (await reader.readline()).strip():
+    pass
+
+  # Read the chunked, newline delimited JSON events:
+  first = None
+  result = None
+  while True:
+    size = int((await reader.readline()).strip(), 16)
+    if size == 0:
+      break
+    event = json.loads(await reader.readexactly(size))
+    await reader.readline()
+    if first is None:
+      first = time.time() - start
+    if event["event"] != "progress":
+      result = event
+  writer.close()
+  return first, time.time() - start, result
+
+def percentile(values, perc):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values)*perc/100.0))]
+
+async def load_test(host, port, clients, n):
+  # Every client asks for one of the jobs, so concurrent requests
+  # for the same scenario get coalesced by the server:
+  jobs = load_jobs()
+  requests = []
+  for i in range(clients):
+    job = dict(jobs[i % len(jobs)], n=n)
+    job.pop("seed", None)
+    requests.append(simulate(host, port, job))
+  start = time.time()
+  results = await asyncio.gather(*requests)
+  elapsed = time.time() - start
+
+  firsts = [r[0] for r in results]
+  totals = [r[1] for r in results]
+  print("Clients: " + str(clients) + ", runs per request: " + str(n))
+  print("Wall time: %0.2fs" % elapsed)
+  print("First progress event:  median %0.2fs, 90th perc %0.2fs" % (percentile(firsts, 50), percentile(firsts, 90)))
+  print("Total request latency: median %0.2fs, 90th perc %0.2fs" % (percentile(totals, 50), percentile(totals, 90)))
+  print("Requests coalesced per simulation: " + str(max(r[2]["coalesced"] for r in results)))
+
+# Main:
+if __name__== "__main__":
+  parser = argparse.ArgumentParser(description="Load test a local stocker simulation server.")
+  parser.add_argument("--port", type=int, default=8765)
+  parser.add_argument("--clients", type=int, default=20)
+  parser.add_argument("-n", type=int, default=400)
+  parser.add_argument("--no-spawn", action="store_true", help="use an already running server")
+  args = parser.parse_args()
+
+  # Start a local server, and wait for it to accept connections:
+  server = None
+  if not args.no_spawn:
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+    server = subprocess.Popen([sys.executable, "-m", "stocker", "--serve", "--port", str(args.port)], cwd=root, stdout=subprocess.DEVNULL)
+    for x in range(100):
+      try:
+        socket.create_connection(("127.0.0.1", args.port), timeout=1.0).close()
+        break
+      except OSError:
+        time.sleep(0.1)
+
+  try:
+    asyncio.run(load_test("127.0.0.1", args.port, args.clients, args.n))
+  finally:
+    if server:
+      server.send_signal(signal.SIGINT)
+      server.wait()
@@ -1,8 +1,10 @@
 import copy
+import json
 import statistics
 import astropy.stats
 import numpy as np
 import abc
+import array
 
 #
 # Value formatting functions:
@@ -314,32 +316,8 @@ class _Scenario_Base(metaclass=abc.ABCMeta):
       self.uncorrected_returns.append(0.0)
 
   def plot(self, figure=None, color='steelblue', label="Value", smooth=False):
-    import matplotlib.pyplot as plt
-    from scipy.signal import savgol_filter
-
-    # Find the median and 10th percentile data sets:
-    data = [p.value()/1000000.0 for p in self.history]
-    # Plot data:
-    if figure:
-      plt.figure(figure.number)
-    else:
-      plt.figure()
-    if smooth:
-      amount = min(9, int(len(data)/5))
-      amount = int(amount/2) * 2 + 1
-      order = 3
-      if order >= amount:
-        order = amount - 1
-      data = savgol_filter(data, amount, order)
-    plt.plot(data, lw=1, color=color, label=label + ' (' + _format_currency(self.history[-1].value()) + ')')
-    plt.fill_between(list(range(len(data))), data, interpolate=False, facecolor=color, alpha=0.5)
-    plt.ylim(bottom=0.0) 
-    plt.xlim(0, len(data) - 1)
-    plt.xlabel('Year')
-    plt.ylabel('Portfolio Value ($M)')
-    plt.title('Portfolio Value Over Time')
-    plt.legend()
-    plt.grid(True)
+    data = [p.value() for p in self.history]
+    _plot_series(np.arange(len(data)), data, data[-1], figure=figure, color=color, label=label, smooth=smooth)
 
   def results(self):
     strn = "'" + self.name + "' Scenario:\n"
@@ -379,9 +357,12 @@ class _Scenario_Base(metaclass=abc.ABCMeta):
 # simulate an age-based portfolio, transferring assets from stocks to
 # bonds as the investment ages.
 # This simple strategy should work for many real life savings projections.
+# A custom per year "rule" can also be provided, see the section on custom
+# rules below.
 class Scenario(_Scenario_Base):
-  def __init__(self, name, portfolio, num_years, inflation_rate_perc=3.5, rebalance=True, annual_contribution=0.0, annual_contribution_increase_perc=0.0, end_weights=None):
+  def __init__(self, name, portfolio, num_years, inflation_rate_perc=3.5, rebalance=True, annual_contribution=0.0, annual_contribution_increase_perc=0.0, end_weights=None, rule=None):
     self.addition = annual_contribution
+    self.rule = rule
     self.addition_increase = annual_contribution_increase_perc/100.0
     self.end_weights = end_weights
     self.slopes = None
@@ -404,15 +385,47 @@ class Scenario(_Scenario_Base):
 
       # Calculate amount to add to portfolio:
       to_add += to_add*self.addition_increase
-      if to_add != 0.0:
-        self.portfolio.trade(to_add)
+      this_add = to_add
+
+      # Apply the custom rule to this year's values, weights and contribution:
+      weights = self.portfolio.weights
+      if self.rule:
+        state = np.array([[p.value for p in self.portfolio.positions]])
+        new_weights = np.array(weights)
+        contributions = np.array([to_add])
+        self.rule(len(self.history) + start_year, state, new_weights, contributions)
+        for p, value in zip(self.portfolio.positions, state[0]):
+          p.value = max(float(value), 0.0)
+        self.portfolio.set_weights(list(new_weights))
+        this_add = float(contributions[0])
+
+      if this_add != 0.0:
+        self.portfolio.trade(this_add)
 
       # Run the base class simulation:
       super(Scenario, self)._run(start_year)
 
+      # Weights changed by the rule only apply to a single year:
+      if self.rule:
+        self.portfolio.weights = weights
+
   def run(self):
     self._run()
 
+  # Describe this scenario for the vectorized engine:
+  def _initial_values(self):
+    return np.array([p.value for p in self.history[0].positions])
+
+  def _phases(self):
+    start_weights = np.array(self.history[0].weights)
+    if self.slopes:
+      weights = start_weights + np.outer(np.arange(self.num_years), self.slopes)
+      weights /= weights.sum(axis=1, keepdims=True)
+    else:
+      weights = np.tile(start_weights, (self.num_years, 1))
+    return [_Phase(self.name, self.history[0].positions, weights, self.addition, self.addition_increase, \
+      self.inflation_rate, self.rebalance, reweight=bool(self.slopes), rule=self.rule)]
+
 # Piecewise scenario:
 # This scenario allows the combinations of other scenarios in a piecewise
 # fashion. A list of scenarios is provided and each is executed in turn.
@@ -454,22 +467,1001 @@ class Piecewise_Scenario(_Scenario_Base):
       self.returns.extend(copy.deepcopy(scenario.returns))
       self.uncorrected_returns.extend(copy.deepcopy(scenario.uncorrected_returns))
 
+  # Describe this scenario for the vectorized engine. The value of each
+  # scenario is transfered to the next, just like in run() above:
+  def _initial_values(self):
+    return self.scenarios[0].portfolio.value()*np.array(self.scenarios[0].history[0].weights)
+
+  def _phases(self):
+    phases = [phase for scenario in self.scenarios for phase in scenario._phases()]
+    for phase in phases:
+      phase.transfer = True
+    return phases
+
+
+#
+# Households:
+#
+# Real plans hold several accounts with different tax treatments. An
+# account is a portfolio of one of three kinds: "taxable" accounts pay
+# capital gains tax on the gains portion of withdrawals (tracked with a
+# cost basis), "tax_deferred" accounts pay income tax on withdrawals, and
+# "roth" accounts withdraw tax free. Each account can receive its own
+# annual contribution.
+class Account(object):
+  kinds = ["taxable", "tax_deferred", "roth"]
+
+  def __init__(self, portfolio, kind="taxable", annual_contribution=0.0, cost_basis=None):
+    assert kind in self.kinds, "Account kind must be one of " + str(self.kinds) + ", not " + str(kind)
+    self.name = portfolio.name
+    self.portfolio = copy.deepcopy(portfolio)
+    self.kind = kind
+    self.contribution = float(annual_contribution)
+    # The cost basis of a taxable account defaults to its current value:
+    self.cost_basis = self.portfolio.value() if cost_basis is None else float(cost_basis)
+
+# A household holds several accounts along with the order in which
+# withdrawals are taken from them (by default taxable, then tax deferred,
+# then roth accounts) and the tax rates that apply to withdrawals:
+class Household(object):
+  def __init__(self, name, accounts, withdrawal_order=None, income_tax_rate_perc=22.0, capital_gains_tax_rate_perc=15.0):
+    self.name = name
+    self.accounts = accounts
+    names = [a.name for a in accounts]
+    assert len(set(names)) == len(names), "Account names must be unique: " + str(names)
+    if withdrawal_order is None:
+      withdrawal_order = [a.name for a in sorted(accounts, key=lambda a: Account.kinds.index(a.kind))]
+    assert sorted(withdrawal_order) == sorted(names), "The withdrawal order must list every account once."
+    self.withdrawal_order = [names.index(name) for name in withdrawal_order]
+    self.income_tax_rate = float(income_tax_rate_perc)/100.0
+    self.capital_gains_tax_rate = float(capital_gains_tax_rate_perc)/100.0
+
+  def value(self):
+    return sum([a.portfolio.value() for a in self.accounts])
+
+# Household scenario:
+# Simulates all accounts of a household jointly for a number of years.
+# Each year, each account receives its contribution (increased annually),
+# then any transfers between accounts are made (ie. Roth conversions, given
+# as (from account name, to account name, annual amount) and taxed like a
+# withdrawal from the source account), then the household's after tax
+# annual spending (increased annually) is withdrawn from the accounts in
+# withdrawal order, grossed up for taxes. Positions with the same name in
+# different accounts share the same random returns. Household scenarios
+# are only simulated by the vectorized engine, with an extra account axis
+# in the state.
+class Household_Scenario(object):
+  def __init__(self, name, household, num_years, annual_spending=0.0, annual_spending_increase_perc=0.0, \
+    annual_contribution_increase_perc=0.0, transfers=(), inflation_rate_perc=3.5, rebalance=True):
+    self.name = name
+    self.household = copy.deepcopy(household)
+    self.num_years = int(num_years)
+    self.spending = float(annual_spending)
+    self.spending_increase = float(annual_spending_increase_perc)/100.0
+    self.contribution_increase = float(annual_contribution_increase_perc)/100.0
+    names = [a.name for a in household.accounts]
+    self.transfers = [(names.index(src), names.index(dst), float(amount)) for src, dst, amount in transfers]
+    self.inflation_rate = float(inflation_rate_perc)/100.0
+    self.rebalance = rebalance
+
+  def reset(self):
+    pass
+
+  def run(self):
+    assert False, "Household scenarios are only simulated by the vectorized engine, use Monte_Carlo.run(n, vectorized=True)."
+
+  # The names of the distinct assets held across all accounts, which are
+  # given the same random returns in every account:
+  def _assets(self):
+    assets = []
+    for a in self.household.accounts:
+      assets.extend([p.name for p in a.portfolio.positions if p.name not in assets])
+    return assets
+
+  # The per run tax rate of withdrawals from an account:
+  def _tax_rates(self, a, balance, basis):
+    kind = self.household.accounts[a].kind
+    if kind == "tax_deferred":
+      return np.full(len(balance), self.household.income_tax_rate)
+    if kind == "taxable":
+      gains = np.divide(np.maximum(balance - basis, 0.0), balance, out=np.zeros_like(balance), where=balance > 0.0)
+      return gains*self.household.capital_gains_tax_rate
+    return np.zeros(len(balance))
+
+  # Withdraw up to the given (gross) amounts from account a in proportion to
+  # its value, updating the (accounts, runs) balances, cost basis and the
+  # fractions kept and amounts added, and returning the amounts net of taxes:
+  def _withdraw(self, a, amounts, gross_up, balance, basis, kept, added):
+    rates = self._tax_rates(a, balance[a], basis[a])
+    if gross_up:
+      amounts = amounts/(1.0 - rates)
+    taken = np.minimum(np.maximum(amounts, 0.0), balance[a])
+    fraction = np.divide(taken, balance[a], out=np.zeros(len(taken)), where=balance[a] > 0.0)
+    kept[a] *= 1.0 - fraction
+    added[a] *= 1.0 - fraction
+    basis[a] *= 1.0 - fraction
+    balance[a] -= taken
+    return taken*(1.0 - rates)
+
+  # Simulate n runs of the household. The state is kept as an (accounts,
+  # positions, runs) array, with the runs innermost so that every account's
+  # positions are contiguous. Contributions, transfers and withdrawals are
+  # first worked out on the (accounts, runs) balances, as masked array
+  # operations, and then applied to the state in a single pass: each
+  # account's positions are scaled by the fraction left after withdrawals
+  # and the amount transfered in is added by weight. Households are always
+  # simulated with NumPy, never by the Numba compiled engine.
+  def _simulate(self, n, rng, dtype=np.float64, recorders=()):
+    dtype = _dtype(dtype)
+    accounts = self.household.accounts
+    num_accounts = len(accounts)
+    num_positions = max(len(a.portfolio.positions) for a in accounts)
+
+    # Pad every account to the same number of positions, mapping each
+    # position to its (shared) asset:
+    assets = self._assets()
+    index = np.zeros((num_accounts, num_positions), dtype=np.intp)
+    ave_returns = np.zeros((num_accounts, num_positions, 1))
+    std_devs = np.zeros((num_accounts, num_positions, 1))
+    weights = np.zeros((num_accounts, num_positions, 1))
+    state = np.zeros((num_accounts, num_positions, n), dtype=dtype)
+    for i, a in enumerate(accounts):
+      for j, (w, p) in enumerate(zip(a.portfolio.weights, a.portfolio.positions)):
+        index[i, j] = assets.index(p.name)
+        ave_returns[i, j], std_devs[i, j], weights[i, j] = p.ave_return, p.std_dev, w
+        state[i, j] = p.value
+    growth = (1.0 + ave_returns).astype(dtype)
+    std_devs = std_devs.astype(dtype)
+    weights = weights.astype(dtype)
+    taxable = np.array([a.kind == "taxable" for a in accounts])
+    basis = np.zeros((num_accounts, n))
+    basis[taxable] = np.array([a.cost_basis for a in accounts])[taxable, np.newaxis]
+    contributions = np.array([a.contribution for a in accounts])
+    draws = np.empty((n, len(assets)), dtype=dtype)
+    returns = np.empty_like(state)
+    balance = np.empty((num_accounts, n), dtype=np.float64)
+    kept = np.empty((num_accounts, n), dtype=np.float64)
+    added = np.empty((num_accounts, n), dtype=np.float64)
+
+    for recorder in recorders:
+      recorder.start(n, self.num_years)
+      recorder.record(0, state.sum(axis=(0, 1), dtype=np.float64))
+
+    spending = self.spending
+    for year in range(1, self.num_years + 1):
+      # Contribute to each account:
+      contributions += contributions*self.contribution_increase
+      state += (contributions[:, np.newaxis, np.newaxis]*weights).astype(dtype)
+      np.maximum(state, 0.0, out=state)
+      basis[taxable] += np.maximum(contributions[taxable], 0.0)[:, np.newaxis]
+      state.sum(axis=1, dtype=np.float64, out=balance)
+      kept[:] = 1.0
+      added[:] = 0.0
+
+      # Transfer between accounts, net of the taxes on the withdrawal:
+      for src, dst, amount in self.transfers:
+        net = self._withdraw(src, np.full(n, amount), False, balance, basis, kept, added)
+        added[dst] += net
+        balance[dst] += net
+        if taxable[dst]:
+          basis[dst] += net
+
+      # Withdraw the after tax spending from each account in turn:
+      spending += spending*self.spending_increase
+      remaining = np.full(n, spending)
+      for a in self.household.withdrawal_order:
+        remaining -= self._withdraw(a, remaining, True, balance, basis, kept, added)
+
+      state *= kept[:, np.newaxis, :].astype(dtype)
+      state += (added[:, np.newaxis, :]*weights).astype(dtype)
+
+      # Simulate a year of growth, sharing the random returns of each asset:
+      rng.standard_normal(out=draws, dtype=dtype)
+      np.take(draws.T, index, axis=0, out=returns)
+      returns *= std_devs
+      returns += growth
+      state *= returns
+      np.maximum(state, 0.0, out=state)
+
+      # Rebalance each account:
+      state.sum(axis=1, dtype=np.float64, out=balance)
+      if self.rebalance:
+        np.multiply(balance[:, np.newaxis, :], weights, out=state)
+
+      discount = 1.0/(1.0 + self.inflation_rate)**year
+      for recorder in recorders:
+        recorder.record(year, balance.sum(axis=0)*discount)
+        if hasattr(recorder, "record_accounts"):
+          recorder.record_accounts(year, balance.T*discount)
+
+    for recorder in recorders:
+      recorder.finish()
+    return state.sum(axis=(0, 1), dtype=np.float64)*(1.0/(1.0 + self.inflation_rate)**self.num_years)
 
 def _remove_outliers(values):
-  # Remove high outliers:
-  med = statistics.median_low(values)
-  MAD = astropy.stats.median_absolute_deviation(values)
-  if MAD > 0.0:
-    values = [v for v in values if v < (med + 4*MAD)]
-    med = statistics.median_low(values)
+  # Remove high outliers, in up to three passes:
+  values = np.asarray(values, dtype=np.float64)
+  for i in range(3):
+    med = np.partition(values, (len(values) - 1)//2)[(len(values) - 1)//2]
     MAD = astropy.stats.median_absolute_deviation(values)
-    if MAD > 0.0:
-      values = [v for v in values if v < (med + 4*MAD)]
-      med = statistics.median_low(values)
-      MAD = astropy.stats.median_absolute_deviation(values)
-      if MAD > 0.0:
-        values = [v for v in values if v < (med + 4*MAD)]
-  return values
+    if MAD <= 0.0:
+      break
+    values = values[values < (med + 4*MAD)]
+  return values.tolist()
+
+#
+# Quantile sketch:
+#
+# A mergeable sketch of a distribution of non-negative values. Values are
+# counted in logarithmically sized buckets so that any quantile can be
+# estimated to within a fixed relative accuracy (0.1% by default) using
+# memory that grows only with the log of the range of the values, not with
+# the number of values. Values of zero (ie. a depleted portfolio) are
+# counted separately.
+class _Quantile_Sketch(object):
+  def __init__(self, accuracy=0.001):
+    self.accuracy = float(accuracy)
+    self.gamma = (1 + self.accuracy)/(1 - self.accuracy)
+    self.log_gamma = np.log(self.gamma)
+    self.count = 0
+    self.zeros = 0
+    self.buckets = {}
+
+  # Add values, each counted weight times, ie. a sample of every weight-th
+  # value of a larger set:
+  def add(self, values, weight=1):
+    # Single precision values are kept in single precision, which is faster
+    # and accurate enough to find their buckets:
+    values = np.asarray(values)
+    if values.dtype != np.float32:
+      values = values.astype(np.float64)
+    positive = values[values > 0.0]
+    self.count += len(values)*weight
+    self.zeros += (len(values) - len(positive))*weight
+    if len(positive) == 0:
+      return
+    # Count the buckets with bincount, which is linear in the number of values:
+    indices = np.ceil(np.log(positive)/positive.dtype.type(self.log_gamma)).astype(np.int64)
+    low = int(indices.min())
+    counts = np.bincount(indices - low)
+    for i in np.flatnonzero(counts).tolist():
+      self.buckets[i + low] = self.buckets.get(i + low, 0) + int(counts[i])*weight
+
+  def merge(self, other):
+    assert self.accuracy == other.accuracy, "Only sketches of equal accuracy can be merged."
+    self.count += other.count
+    self.zeros += other.zeros
+    for i, c in other.buckets.items():
+      self.buckets[i] = self.buckets.get(i, 0) + c
+
+  # Return the bucket values and counts in sorted order:
+  def _sorted(self):
+    indices = np.array(sorted(self.buckets), dtype=np.int64)
+    counts = np.array([self.buckets[i] for i in indices], dtype=np.int64)
+    values = 2.0*self.gamma**indices/(self.gamma + 1.0)
+    return np.concatenate(([0.0], values)), np.concatenate(([self.zeros], counts))
+
+  # Estimate the value of the given rank (0 is the smallest value):
+  def value_at_rank(self, rank):
+    assert self.count > 0, "The sketch is empty."
+    values, counts = self._sorted()
+    return float(values[np.searchsorted(np.cumsum(counts), rank, side='right')])
+
+  # Estimate the median absolute deviation from the median:
+  def mad(self):
+    values, counts = self._sorted()
+    median = np.median([self.value_at_rank((self.count - 1)//2), self.value_at_rank(self.count//2)])
+    deviations = np.abs(values - median)
+    order = np.argsort(deviations)
+    deviations, counts = deviations[order], np.cumsum(counts[order])
+    low = deviations[np.searchsorted(counts, (self.count - 1)//2, side='right')]
+    high = deviations[np.searchsorted(counts, self.count//2, side='right')]
+    return float(low + high)/2.0
+
+  # A copy of the sketch holding only the values below the threshold:
+  def below(self, threshold):
+    sketch = _Quantile_Sketch(self.accuracy)
+    sketch.zeros = self.zeros if threshold > 0.0 else 0
+    sketch.buckets = {i: c for i, c in self.buckets.items() if 2.0*self.gamma**i/(self.gamma + 1.0) < threshold}
+    sketch.count = sketch.zeros + sum(sketch.buckets.values())
+    return sketch
+
+  # Estimate the values left by _remove_outliers, returning a sketch of
+  # them and the threshold below which values were kept:
+  def remove_outliers(self):
+    sketch = self
+    threshold = np.inf
+    for i in range(3):
+      mad = sketch.mad()
+      if mad <= 0.0:
+        break
+      threshold = sketch.value_at_rank((sketch.count - 1)//2) + 4*mad
+      sketch = sketch.below(threshold)
+    return sketch, threshold
+
+#
+# Monte Carlo summary:
+#
+# Summary statistics of the final values of a Monte Carlo simulation that
+# are updated incrementally as runs are added, in time proportional to the
+# number of runs added, and that can be merged with the summary of another
+# simulation of the same scenario. The mean and standard deviation, the
+# minimum and maximum, and the likelihood of meeting any tracked goal are
+# exact. The median, percentiles and MAD are estimated from a quantile
+# sketch and are accurate to within 0.1% by default.
+class Monte_Carlo_Summary(object):
+  def __init__(self, accuracy=0.001):
+    self.count = 0
+    self.mean = 0.0
+    self.m2 = 0.0
+    self.min = float('inf')
+    self.max = float('-inf')
+    self.sketch = _Quantile_Sketch(accuracy)
+    self.goals = {}
+
+  def add(self, values):
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+      return
+    other = Monte_Carlo_Summary(self.sketch.accuracy)
+    other.count = len(values)
+    other.mean = float(np.mean(values))
+    other.m2 = float(np.sum((values - other.mean)**2))
+    other.min = float(np.min(values))
+    other.max = float(np.max(values))
+    other.sketch.add(values)
+    other.goals = {goal: int(np.count_nonzero(values > goal)) for goal in self.goals}
+    self.merge(other)
+
+  # Merge another summary into this one. Only goals tracked by both
+  # summaries remain tracked:
+  def merge(self, other):
+    count = self.count + other.count
+    if count > 0:
+      delta = other.mean - self.mean
+      self.m2 += other.m2 + delta**2*self.count*other.count/count
+      self.mean += delta*other.count/count
+    self.count = count
+    self.min = min(self.min, other.min)
+    self.max = max(self.max, other.max)
+    self.sketch.merge(other.sketch)
+    self.goals = {goal: hits + other.goals[goal] for goal, hits in self.goals.items() if goal in other.goals}
+    return self
+
+  # Start tracking the likelihood of meeting a goal. The values already
+  # added to the summary must be provided so that they can be counted:
+  def track_goal(self, goal, values=()):
+    goal = float(goal)
+    if goal not in self.goals:
+      assert len(values) == self.count, "All values in the summary are needed to track a new goal."
+      self.goals[goal] = int(np.count_nonzero(np.asarray(values, dtype=np.float64) > goal))
+
+  def std_dev(self):
+    assert self.count > 1, "At least two values are needed to calculate a standard deviation."
+    return (self.m2/(self.count - 1))**0.5
+
+  def median(self):
+    return self.sketch.value_at_rank((self.count - 1)//2)
+
+  def percentile(self, perc):
+    return self.sketch.value_at_rank(int(round(perc/100.0*(self.count - 1))))
+
+  def mad(self):
+    return self.sketch.mad()
+
+  def goal_probability(self, goal):
+    assert float(goal) in self.goals, "Goal " + _format_currency(goal) + " is not tracked."
+    return self.goals[float(goal)]/self.count
+
+#
+# Vectorized engine:
+#
+# Simulates many runs of a scenario at once with NumPy. A scenario is
+# described to the engine as a list of phases (one per Scenario, see
+# Scenario._phases), and the engine walks the years of each phase, updating
+# a (runs, positions) array of position values in place. It follows the
+# same rules as the Position, Portfolio and Scenario classes above, but
+# draws its random returns from a NumPy Generator, so it is much faster
+# but does not reproduce the runs of the object based simulation.
+#
+# With dtype=np.float32 the position values and the random returns are
+# kept in single precision, halving memory use and bandwidth for large
+# numbers of runs, while portfolio totals and the inflation correction of
+# the final values are always computed in double precision.
+class _Phase(object):
+  def __init__(self, name, positions, weights, contribution, contribution_increase, inflation_rate, rebalance, reweight=False, transfer=False, rule=None):
+    self.name = name
+    self.num_years = len(weights)
+    self.position_names = [p.name for p in positions]
+    self.ave_returns = np.array([p.ave_return for p in positions])
+    self.std_devs = np.array([p.std_dev for p in positions])
+    # The (normalized) weights for each year of the phase:
+    self.weights = np.asarray(weights, dtype=np.float64)
+    self.contribution = float(contribution)
+    self.contribution_increase = float(contribution_increase)
+    self.inflation_rate = float(inflation_rate)
+    self.rebalance = rebalance
+    # Rebalance to the weights of each year before contributing:
+    self.reweight = reweight
+    # Redistribute the total value of the previous phase by weight:
+    self.transfer = transfer
+    # Custom per year rule, see below:
+    self.rule = rule
+
+def _dtype(dtype):
+  dtype = np.dtype(dtype)
+  assert dtype in (np.float32, np.float64), "Only float32 and float64 simulations are supported, not " + str(dtype)
+  return dtype
+
+#
+# Year step kernels:
+#
+# Simulate one year of every run of every variant in place: rebalance to
+# this year's weights (if reweight is set), add the contributions, grow
+# each position by its ave return plus its std deviation times the drawn
+# standard normal returns (shared by all variants), and rebalance (if
+# rebalance is set). The inflation corrected total of each run is written
+# to total. The shapes are state (variants, runs, positions), returns
+# (runs, positions), growth, std_devs and weights (variants, positions),
+# contributions (variants, runs) or (variants, 1), and discount
+# (variants,). When Numba is installed the compiled kernel is used, which
+# does all of this in a single parallel pass over the runs, otherwise the
+# equivalent NumPy version is used.
+def _numpy_year(state, returns, growth, std_devs, weights, contributions, reweight, rebalance, discount, total):
+  weights = weights[:, np.newaxis, :]
+  if reweight:
+    state.sum(axis=-1, dtype=np.float64, out=total)
+    np.multiply(total[..., np.newaxis], weights, out=state)
+  if contributions.any():
+    state += (contributions[..., np.newaxis]*weights).astype(state.dtype)
+    np.maximum(state, 0.0, out=state)
+  if len(state) == 1:
+    returns *= std_devs[0]
+    returns += growth[0]
+    state *= returns
+  else:
+    for v in range(len(state)):
+      state[v] *= returns*std_devs[v] + growth[v]
+  np.maximum(state, 0.0, out=state)
+  state.sum(axis=-1, dtype=np.float64, out=total)
+  if rebalance:
+    np.multiply(total[..., np.newaxis], weights, out=state)
+  total *= discount[:, np.newaxis]
+
+try:
+  import numba
+except ImportError:
+  numba = None
+
+if numba:
+  @numba.njit(parallel=True, cache=True)
+  def _numba_year(state, returns, growth, std_devs, weights, contributions, reweight, rebalance, discount, total):
+    num_variants, n, k = state.shape
+    per_run = contributions.shape[1] > 1
+    for v in range(num_variants):
+      for i in numba.prange(n):
+        if reweight:
+          value = 0.0
+          for j in range(k):
+            value += state[v, i, j]
+          for j in range(k):
+            state[v, i, j] = value*weights[v, j]
+        contribution = contributions[v, i] if per_run else contributions[v, 0]
+        value = 0.0
+        for j in range(k):
+          position = state[v, i, j]
+          if contribution != 0.0:
+            position = max(position + contribution*weights[v, j], 0.0)
+          position = max(position*(growth[v, j] + std_devs[v, j]*returns[i, j]), 0.0)
+          state[v, i, j] = position
+          value += position
+        if rebalance:
+          for j in range(k):
+            state[v, i, j] = value*weights[v, j]
+        total[v, i] = value*discount[v]
+
+#
+# Custom rules:
+#
+# A Scenario can be given a custom "rule", a function that is called at
+# the start of every simulated year, before that year's contribution and
+# growth, as:
+#
+#   rule(year, state, weights, contributions)
+#
+#   year          - the year being simulated, counting from 1 at the start
+#                   of the (piecewise) scenario
+#   state         - a (runs, positions) array of the (not inflation
+#                   corrected) value of each position in each run
+#   weights       - a (positions,) array of this year's normalized weights
+#   contributions - a (runs,) array of the amount to add to (or, if
+#                   negative, take from) each run this year
+#
+# The rule may modify all three arrays in place: changing state trades
+# positions directly, changing weights changes the allocation of this
+# year's contribution and rebalancing, and changing contributions changes
+# this year's contribution of each run. Rules should use plain NumPy
+# operations and loops so that the same function works in the object
+# based simulation (with a single run), in the vectorized engine, and,
+# decorated with stocker.jit, compiled by Numba when it is installed:
+#
+#   @stocker.jit
+#   def guardrail(year, state, weights, contributions):
+#     for i in range(state.shape[0]):
+#       if state[i].sum() < 500000.0:
+#         contributions[i] *= 0.9
+#
+def jit(function):
+  if numba:
+    # Functions defined interactively can't be cached on disk:
+    try:
+      return numba.njit(cache=True)(function)
+    except RuntimeError:
+      return numba.njit(function)
+  return function
+
+# Simulate n runs of the scenario, returning the inflation corrected final
+# value of every run. Years are simulated one at a time, in place, so the
+# memory used is proportional to n times the number of positions no matter
+# how many years are simulated. Anything else needed from the simulation is
+# collected by recorders (see below). Unless use_numba is False, the Numba
+# compiled year step is used when Numba is installed:
+def _simulate(scenario, n, rng, dtype=np.float64, recorders=(), use_numba=True):
+  # Households are always simulated with NumPy (see above):
+  if isinstance(scenario, Household_Scenario):
+    return scenario._simulate(n, rng, dtype, recorders)
+  return _simulate_variants(scenario._initial_values(), [scenario._phases()], n, rng, dtype, recorders, use_numba)[0]
+
+# Simulate n runs of several variants of the same scenario at once, ie.
+# with different returns, contributions or inflation rates, returning a
+# (variants, n) array of final values. The phases of every variant must
+# have the same positions, weights, durations and rules. All variants share
+# the same random returns, so the differences between them are not due to
+# sampling noise. The state is a (variants, runs, positions) array, and
+# recorders are given (variants, runs) values when there is more than one
+# variant:
+def _simulate_variants(initial_values, variants, n, rng, dtype=np.float64, recorders=(), use_numba=True):
+  dtype = _dtype(dtype)
+  year_step = _numba_year if numba and use_numba else _numpy_year
+  num_variants = len(variants)
+  state = np.empty((num_variants, n, len(variants[0][0].weights[0])), dtype=dtype)
+  state[:] = initial_values
+  total = np.empty((num_variants, n), dtype=np.float64)
+  values = total if num_variants > 1 else total[0]
+
+  num_years = sum(phase.num_years for phase in variants[0])
+  state.sum(axis=-1, dtype=np.float64, out=total)
+  for recorder in recorders:
+    recorder.start(n, num_years)
+    recorder.record(0, values)
+
+  year = 0
+  for p, phase in enumerate(variants[0]):
+    stack = lambda name: np.array([getattr(v[p], name) for v in variants])
+    weights = phase.weights.astype(dtype)
+    growth = (1.0 + stack("ave_returns")).astype(dtype)
+    std_devs = stack("std_devs").astype(dtype)
+    increases = stack("contribution_increase")
+    discounts = 1.0/(1.0 + stack("inflation_rate"))
+    if phase.transfer:
+      state.sum(axis=-1, dtype=np.float64, out=total)
+      if state.shape[-1] != weights.shape[1]:
+        state = np.empty((num_variants, n, weights.shape[1]), dtype=dtype)
+      np.multiply(total[..., np.newaxis], weights[0], out=state)
+    returns = np.empty(state.shape[1:], dtype=dtype)
+
+    to_add = stack("contribution")
+    for x in range(phase.num_years):
+      year += 1
+      to_add += to_add*increases
+      year_weights = np.repeat(weights[x][np.newaxis], num_variants, axis=0)
+
+      # Apply the custom rule to each variant, after rebalancing to this
+      # year's weights:
+      reweight = phase.reweight
+      if phase.rule:
+        if reweight:
+          state.sum(axis=-1, dtype=np.float64, out=total)
+          np.multiply(total[..., np.newaxis], weights[x], out=state)
+          reweight = False
+        contributions = np.repeat(to_add[:, np.newaxis], n, axis=1)
+        for v in range(num_variants):
+          phase.rule(year, state[v], year_weights[v], contributions[v])
+        np.maximum(state, 0.0, out=state)
+        year_weights /= year_weights.sum(axis=1, keepdims=True)
+        year_weights = year_weights.astype(dtype)
+      else:
+        contributions = to_add[:, np.newaxis]
+
+      # Simulate the year, using the same random draws for every variant:
+      rng.standard_normal(out=returns, dtype=dtype)
+      year_step(state, returns, growth, std_devs, year_weights, contributions, reweight, phase.rebalance, discounts**year, total)
+
+      for recorder in recorders:
+        recorder.record(year, values)
+
+  for recorder in recorders:
+    recorder.finish()
+  return total
+
+#
+# Recorders:
+#
+# Recorders collect results from the vectorized engine while it runs. Once
+# the simulation of n runs over num_years years starts, each recorder's
+# start(n, num_years) is called, followed by record(year, values) for the
+# starting values (year 0) and after every simulated year, and finally
+# finish(). The values are the inflation corrected portfolio value of each
+# run, in a buffer that is reused by the engine, so a recorder must copy
+# anything it keeps. Only what the recorders keep is stored.
+class Recorder(metaclass=abc.ABCMeta):
+  def start(self, n, num_years): pass
+
+  @abc.abstractmethod
+  def record(self, year, values): pass
+
+  def finish(self): pass
+
+# Records the final value of each run:
+class Final_Value_Recorder(Recorder):
+  def __init__(self):
+    self.num_years = None
+    self.values = None
+
+  def start(self, n, num_years):
+    self.num_years = num_years
+
+  def record(self, year, values):
+    if year == self.num_years:
+      self.values = values.copy()
+
+# Records the value of each run at the given years:
+class Year_Recorder(Recorder):
+  def __init__(self, years):
+    self.years = [int(y) for y in years]
+    self.values = {}
+
+  def record(self, year, values):
+    if year in self.years:
+      self.values[year] = values.copy()
+
+# Records the given percentiles of the values of all runs at every year,
+# into a (years + 1, percentiles) array:
+class Percentile_Recorder(Recorder):
+  def __init__(self, percentiles=(10, 50, 90)):
+    self.percentiles = list(percentiles)
+    self.values = None
+
+  def start(self, n, num_years):
+    self.values = np.empty((num_years + 1, len(self.percentiles)))
+
+  def record(self, year, values):
+    self.values[year] = np.percentile(values, self.percentiles)
+
+# Records a quantile sketch of the values of all runs for every year. Unlike
+# percentiles, the sketches of different simulations of the same scenario
+# can be merged. The runs are independent, so to keep recording cheap only
+# every k-th run is added to the sketches, such that at least max_values
+# runs are added. Each added run is weighted by the number of runs it
+# stands for: k, or fewer for the last one:
+class Year_Sketch_Recorder(Recorder):
+  def __init__(self, accuracy=0.001, max_values=100000):
+    self.accuracy = accuracy
+    self.max_values = max_values
+    self.stride = 1
+    self.sketches = []
+
+  def start(self, n, num_years):
+    self.stride = max(n//self.max_values, 1)
+    self.sketches = [_Quantile_Sketch(self.accuracy) for year in range(num_years + 1)]
+
+  def record(self, year, values):
+    sample = values[::self.stride]
+    self.sketches[year].add(sample[:-1], self.stride)
+    self.sketches[year].add(sample[-1:], len(values) - (len(sample) - 1)*self.stride)
+
+# Records the year in which each run's portfolio was first depleted, or -1
+# for runs that never ran out of money:
+class Ruin_Recorder(Recorder):
+  def __init__(self):
+    self.num_years = None
+    self.years = None
+
+  def start(self, n, num_years):
+    self.num_years = num_years
+    self.years = np.full(n, -1, dtype=np.int32)
+
+  def record(self, year, values):
+    if year > 0:
+      self.years[(values <= 0.0) & (self.years < 0)] = year
+
+  # The likelihood of having been depleted by each year:
+  def probability(self):
+    ruined = np.bincount(self.years[self.years >= 0], minlength=self.num_years + 1)
+    return np.cumsum(ruined)/len(self.years)
+
+# Records the inflation corrected value of each account of a household
+# scenario in every run at the final year, as a (runs, accounts) array:
+class Account_Recorder(Final_Value_Recorder):
+  def record(self, year, values):
+    pass
+
+  def record_accounts(self, year, values):
+    if year == self.num_years:
+      self.values = values.copy()
+
+#
+# Shared memory:
+#
+# Vectorized simulations can be split across processes without pickling
+# any large arrays. The random returns of every run are drawn once, up
+# front, into a shared memory block that all workers read, and each worker
+# writes the final values (and optionally the value of every year) of its
+# slice of the runs directly into shared output blocks. Only small handles
+# naming the blocks are sent to the workers, and only the bounds of each
+# slice are sent back. The random returns depend only on the seed and the
+# number of runs, not on the number of processes, and the same shared
+# returns can be reused to simulate several variants of a scenario (ie. a
+# parameter sweep) on common random numbers.
+class Shared_Array(object):
+  def __init__(self, shape, dtype=np.float64, name=None):
+    from multiprocessing import shared_memory
+    self.shape = tuple(shape)
+    self.dtype = np.dtype(dtype)
+    size = max(int(np.prod(self.shape))*self.dtype.itemsize, 1)
+    self.owner = name is None
+    self.memory = shared_memory.SharedMemory(name=name, create=self.owner, size=size)
+    self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.memory.buf)
+
+  # A small, picklable description of the block for other processes:
+  def handle(self):
+    return (self.memory.name, self.shape, self.dtype.str)
+
+  @classmethod
+  def attach(cls, handle):
+    name, shape, dtype = handle
+    return cls(shape, dtype, name)
+
+  def close(self):
+    self.array = None
+    self.memory.close()
+    if self.owner:
+      self.memory.unlink()
+
+# Draw the standard normal random returns of n runs of the scenario into
+# shared memory, as a (years, runs, positions) array, where positions is
+# the largest number of positions of any phase:
+def _num_years(scenario):
+  if isinstance(scenario, Household_Scenario):
+    return scenario.num_years
+  return sum(phase.num_years for phase in scenario._phases())
+
+def shared_returns(scenario, n, seed=None, dtype=np.float64):
+  dtype = _dtype(dtype)
+  if isinstance(scenario, Household_Scenario):
+    width = len(scenario._assets())
+  else:
+    width = max(len(phase.weights[0]) for phase in scenario._phases())
+  num_years = _num_years(scenario)
+  returns = Shared_Array((num_years, n, width), dtype)
+  rng = np.random.default_rng(seed)
+  for year in range(num_years):
+    rng.standard_normal(out=returns.array[year], dtype=dtype)
+  return returns
+
+# Replays a slice of the runs of shared random returns in place of the
+# random generator of the vectorized engine:
+class _Returns_Replay(object):
+  def __init__(self, returns, start, stop):
+    self.returns = returns
+    self.start = start
+    self.stop = stop
+    self.year = 0
+
+  def standard_normal(self, out, dtype):
+    out[...] = self.returns[self.year, self.start:self.stop, :out.shape[-1]]
+    self.year += 1
+
+# Records the value of every year of a slice of the runs into a shared
+# (years + 1, runs) array:
+class _Shared_Recorder(Recorder):
+  def __init__(self, values, first_run):
+    self.values = values
+    self.first_run = first_run
+
+  def record(self, year, values):
+    self.values[year, self.first_run:self.first_run + len(values)] = values
+
+def _shared_worker(scenario, returns_handle, finals_handle, years_handle, start, stop, dtype, use_numba, threads, sketchers):
+  # Share the CPUs between the worker processes:
+  if numba and use_numba:
+    numba.set_num_threads(min(threads, numba.config.NUMBA_NUM_THREADS))
+  blocks = [Shared_Array.attach(h) for h in (returns_handle, finals_handle, years_handle) if h]
+  try:
+    recorders = [_Shared_Recorder(blocks[2].array, start)] if years_handle else []
+    replay = _Returns_Replay(blocks[0].array, start, stop)
+    blocks[1].array[start:stop] = _simulate(scenario, stop - start, replay, dtype, recorders + sketchers, use_numba)
+    del replay, recorders
+  finally:
+    for block in blocks:
+      block.close()
+  return [sketcher.sketches for sketcher in sketchers]
+
+# Simulate n runs of the scenario across a pool of processes, returning the
+# final value of every run. If returns (see shared_returns) are not given
+# they are drawn from the seed. Recorders are run in the parent process on
+# the shared values of every year, which are only kept if recorders are
+# given. Year sketch recorders are mergeable, so they are run in the worker
+# processes instead and merged, without keeping the values of every year:
+def simulate_shared(scenario, n, processes=None, seed=None, dtype=np.float64, recorders=(), returns=None, use_numba=True):
+  import concurrent.futures
+  import os
+  dtype = _dtype(dtype)
+  processes = processes or os.cpu_count()
+  assert not any(isinstance(r, Account_Recorder) for r in recorders), "Account recorders aren't supported when running across processes."
+  sketchers = [r for r in recorders if isinstance(r, Year_Sketch_Recorder)]
+  recorders = [r for r in recorders if not isinstance(r, Year_Sketch_Recorder)]
+  num_years = _num_years(scenario)
+  own_returns = returns is None
+  if own_returns:
+    returns = shared_returns(scenario, n, seed, dtype)
+  assert returns.shape[0] == num_years and returns.shape[1] == n, "The shared returns don't match the scenario and number of runs."
+  finals = Shared_Array((n,), np.float64)
+  years = Shared_Array((num_years + 1, n), np.float64) if recorders else None
+  try:
+    bounds = np.linspace(0, n, processes + 1).astype(int)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+      worker_sketchers = [Year_Sketch_Recorder(r.accuracy, max(r.max_values//processes, 1)) for r in sketchers]
+      futures = [executor.submit(_shared_worker, scenario, returns.handle(), finals.handle(), years.handle() if years else None, \
+        int(start), int(stop), dtype.str, use_numba, max(1, os.cpu_count()//processes), worker_sketchers) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+      for sketcher in sketchers:
+        sketcher.start(n, num_years)
+      for future in futures:
+        for sketcher, sketches in zip(sketchers, future.result()):
+          for sketch, other in zip(sketcher.sketches, sketches):
+            sketch.merge(other)
+      for sketcher in sketchers:
+        sketcher.finish()
+    for recorder in recorders:
+      recorder.start(n, num_years)
+      for year in range(num_years + 1):
+        recorder.record(year, years.array[year])
+      recorder.finish()
+    return finals.array.copy()
+  finally:
+    finals.close()
+    if years:
+      years.close()
+    if own_returns:
+      returns.close()
+
+#
+# Plot data:
+#
+# Histograms and plots of a Monte Carlo simulation are rendered from plot
+# data that is computed once from the final values and cached, so that they
+# render quickly however many runs there are. Matplotlib is only imported
+# when they are rendered.
+
+# Return the indices of at most max_points evenly spaced points of a series
+# of the given length, always including the first and the last point:
+def _downsample(length, max_points):
+  if length <= max_points:
+    return np.arange(length)
+  return np.unique(np.linspace(0, length - 1, max_points).round().astype(np.int64))
+
+# Plot a series of portfolio values over the given years:
+def _plot_series(years, values, final_value, figure=None, color='steelblue', label="Value", smooth=False):
+  import matplotlib.pyplot as plt
+  from scipy.signal import savgol_filter
+
+  data = np.asarray(values, dtype=np.float64)/1000000.0
+  if figure:
+    plt.figure(figure.number)
+  else:
+    plt.figure()
+  if smooth:
+    amount = min(9, int(len(data)/5))
+    amount = int(amount/2) * 2 + 1
+    order = 3
+    if order >= amount:
+      order = amount - 1
+    data = savgol_filter(data, amount, order)
+  plt.plot(years, data, lw=1, color=color, label=label + ' (' + _format_currency(final_value) + ')')
+  plt.fill_between(years, data, interpolate=False, facecolor=color, alpha=0.5)
+  plt.ylim(bottom=0.0)
+  plt.xlim(years[0], years[-1])
+  plt.xlabel('Year')
+  plt.ylabel('Portfolio Value ($M)')
+  plt.title('Portfolio Value Over Time')
+  plt.legend()
+  plt.grid(True)
+
+# The bins of the final value histogram of a Monte Carlo simulation: a bin
+# for values below $1 (ie. a depleted portfolio) and bins that are 1% wide
+# on a log scale up to $10 trillion. The bins don't depend on the scenario,
+# so the histograms of any two shards can be merged.
+_histogram_edges = np.concatenate(([0.0], np.geomspace(1.0, 1e13, 3001)))
+
+# A histogram of values over fixed bins. Histograms over the same bins, ie.
+# of shards of a simulation run on different machines, can be merged.
+# Values outside of the bins are counted but not binned.
+class Histogram_Data(object):
+  def __init__(self, edges):
+    self.edges = np.asarray(edges, dtype=np.float64)
+    assert len(self.edges) > 1 and np.all(np.diff(self.edges) > 0.0), "The bin edges must be increasing."
+    self.counts = np.zeros(len(self.edges) - 1, dtype=np.int64)
+    self.below = 0
+    self.above = 0
+
+  def add(self, values):
+    values = np.asarray(values, dtype=np.float64)
+    self.counts += np.histogram(values, self.edges)[0]
+    self.below += int(np.count_nonzero(values < self.edges[0]))
+    self.above += int(np.count_nonzero(values > self.edges[-1]))
+    return self
+
+  def merge(self, other):
+    assert np.array_equal(self.edges, other.edges), "Only histograms over the same bins can be merged."
+    self.counts += other.counts
+    self.below += other.below
+    self.above += other.above
+    return self
+
+  # Return a histogram over other (ie. coarser) bins, of only the bins
+  # centered below the threshold. The values of each bin are assumed to be
+  # spread evenly over it, so the new counts can be fractional. Values
+  # outside of the new bins are counted in the first or last bin:
+  def rebin(self, edges, threshold=np.inf):
+    histogram = Histogram_Data(edges)
+    low, high = self.edges[:-1], self.edges[1:]
+    counts = np.where(np.where(low > 0.0, np.sqrt(low*high), low) < threshold, self.counts, 0)
+    cumulative = np.interp(histogram.edges, self.edges, np.concatenate(([0], np.cumsum(counts))))
+    histogram.counts = np.diff(cumulative)
+    histogram.counts[0] += cumulative[0]
+    histogram.counts[-1] += counts.sum() - cumulative[-1]
+    return histogram
+
+  # The percentage of the binned values in each bin:
+  def percentages(self):
+    return self.counts*100.0/max(int(self.counts.sum()), 1)
+
+# The data of the histogram and the plot of a Monte Carlo simulation. The
+# series are the values over time of the median and 10th percentile runs,
+# as (label, color, years, values, final value) tuples.
+class Plot_Data(object):
+  def __init__(self, count, histogram, median, tenth, mad, series):
+    self.count = count
+    self.histogram = histogram
+    self.median = median
+    self.tenth = tenth
+    self.two_mad = max(median - 2*mad, 0.0)
+    self.series = series
+
+  def render_histogram(self):
+    import matplotlib.pyplot as plt
+    edges = self.histogram.edges/1000000.0
+    plt.figure()
+    plt.hist(edges[:-1], edges, weights=self.histogram.percentages(), facecolor='0.5', alpha=0.75)
+    plt.axvline(x=self.median/1000000.0, color='g')
+    plt.axvline(x=self.tenth/1000000.0, color='r')
+    plt.axvline(x=self.two_mad/1000000.0, color='m')
+    plt.legend([ \
+      'Median (' + _format_currency(self.median) + ')', \
+      '10th Perc (' + _format_currency(self.tenth) + ')', \
+      r'-2*MAD (' + _format_currency(self.two_mad) + ')', \
+    ])
+    plt.xlabel('Portfolio Value ($M)')
+    plt.ylabel('Probability %')
+    plt.title('Final Portfolio Value Probability Distribution (n=' + str(self.count) + ")")
+    plt.grid(True)
+
+  def render_plot(self, smooth=False):
+    import matplotlib.pyplot as plt
+    assert self.series, "Only runs of the non-vectorized simulation, or vectorized runs in a single process, can be plotted."
+    f = plt.figure()
+    for label, color, years, values, final_value in self.series:
+      _plot_series(years, values, final_value, figure=f, color=color, label=label, smooth=smooth)
 
 #
 # The Monte Carlo class
@@ -478,92 +1470,966 @@ def _remove_outliers(values):
 # storing the result for each run. After running, statistics can be 
 # gathered on aggregate outcomes of the executed scenarios.
 class Monte_Carlo(object):
-  def __init__(self, scenario):
+  def __init__(self, scenario, seed=None):
     self.scenario = copy.deepcopy(scenario)
     self.scenario.reset()
     self.runs = []
     self.values = []
-    self.raw_values = []
-    
-  def run(self, n):
+    # The final values are kept in a compact array of doubles:
+    self.raw_values = array.array('d')
+    self.summary = Monte_Carlo_Summary()
+    # Histogram of the final values, over fixed bins (see below):
+    self.histogram_data = Histogram_Data(_histogram_edges)
+    # Quantile sketches of the values of all vectorized runs for every year:
+    self.year_sketches = []
+    # Random generator used by the vectorized engine:
+    self.rng = np.random.default_rng(seed)
+    self._plot_data = None
+    self._plot_data_key = None
+    # The file, number of runs and number of values of the last checkpoint:
+    self._checkpoint = None
+
+  # Run the scenario n more times. If a checkpoint file is given it is
+  # saved every "checkpoint_every" runs (by default 100, or 100000 for
+  # vectorized runs), so that an interrupted simulation can be resumed with
+  # Monte_Carlo.from_checkpoint.
+  # If vectorized is set, the runs are simulated all at once by the
+  # vectorized engine in the given dtype (float64 or float32). Vectorized
+  # runs only keep their final values, so they cannot be plotted, but
+  # recorders can be given to collect other results (see above). The Numba
+  # compiled engine is used when Numba is installed, unless use_numba is False.
+  # Vectorized runs are split across a pool of processes sharing memory (see
+  # above) if more than one process is given. Household scenarios are
+  # always simulated by the vectorized engine.
+  def run(self, n, checkpoint=None, checkpoint_every=None, vectorized=False, dtype=np.float64, recorders=(), use_numba=True, processes=None):
+    if isinstance(self.scenario, Household_Scenario):
+      vectorized = True
+    assert vectorized or not (processes and processes > 1), "Only vectorized runs can be split across processes."
+    if vectorized and processes and processes > 1:
+      assert not checkpoint, "Checkpoints aren't supported when running across processes."
+      seed = int(self.rng.integers(2**63))
+      sketches = Year_Sketch_Recorder()
+      self._add(simulate_shared(self.scenario, n, processes, seed, dtype, tuple(recorders) + (sketches,), use_numba=use_numba))
+      self._merge_year_sketches(sketches.sketches)
+      return
+    if vectorized:
+      assert not (checkpoint and recorders), "Recorders can't be used with checkpoints, they need all runs at once."
+      size = (checkpoint_every or 100000) if checkpoint else n
+      for start in range(0, n, size):
+        sketches = Year_Sketch_Recorder()
+        self._add(_simulate(self.scenario, min(size, n - start), self.rng, dtype, tuple(recorders) + (sketches,), use_numba))
+        self._merge_year_sketches(sketches.sketches)
+        if checkpoint:
+          self.save_checkpoint(checkpoint)
+      return
+
+    batch = []
     for x in range(n):
       new_scenario = copy.deepcopy(self.scenario)
       new_scenario.run()
-      self.raw_values.append(new_scenario.history[-1].value())
+      batch.append(new_scenario.history[-1].value())
       self.runs.append(new_scenario)
+      if checkpoint and len(batch) >= (checkpoint_every or 100):
+        self._add(batch)
+        self.save_checkpoint(checkpoint)
+        batch = []
+    self._add(batch)
+    if checkpoint:
+      self.save_checkpoint(checkpoint)
+
+  def _add(self, values):
+    values = np.asarray(values, dtype=np.float64)
+    self.summary.add(values)
+    self.histogram_data.add(values)
+    self.raw_values.frombytes(values.tobytes())
+
+  def _merge_year_sketches(self, sketches):
+    if not self.year_sketches:
+      self.year_sketches = sketches
+    elif sketches:
+      for sketch, other in zip(self.year_sketches, sketches):
+        sketch.merge(other)
+
+  # Merge the runs of another simulation of the same scenario, ie. a shard
+  # run on a different machine, into this one:
+  def merge(self, other):
+    assert self.scenario.name == other.scenario.name, "Only simulations of the same scenario can be merged."
+    self.runs.extend(other.runs)
+    self.raw_values.extend(other.raw_values)
+    self.summary.merge(other.summary)
+    self.histogram_data.merge(other.histogram_data)
+    self._merge_year_sketches(copy.deepcopy(other.year_sketches))
+    return self
+
+  # Checkpoints are append-only: the first checkpoint of a simulation to a
+  # file holds all of its runs, and every later one appends only the runs
+  # added since, along with the (small) summary and random state:
+  def save_checkpoint(self, filename):
+    import os
+    import pickle
+    state = {
+      "summary": self.summary,
+      "histogram_data": self.histogram_data,
+      "year_sketches": self.year_sketches,
+      "random_state": np.random.get_state(),
+      "rng_state": self.rng.bit_generator.state,
+    }
+    saved = self._checkpoint
+    path = os.path.abspath(filename)
+    if saved and saved[0] == path and saved[1] <= len(self.runs) and saved[2] <= len(self.raw_values) and os.path.exists(path):
+      state["runs"] = self.runs[saved[1]:]
+      state["raw_values"] = self.raw_values[saved[2]:]
+      with open(path, "ab") as f:
+        pickle.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    else:
+      state["scenario"] = self.scenario
+      state["runs"] = self.runs
+      state["raw_values"] = self.raw_values
+      # Write to a temporary file first so that an interruption never
+      # leaves a partially written checkpoint behind:
+      with open(path + ".tmp", "wb") as f:
+        pickle.dump(state, f)
+      os.replace(path + ".tmp", path)
+    self._checkpoint = (path, len(self.runs), len(self.raw_values))
+
+  # Load a simulation from a checkpoint file. By default the random state
+  # is restored too, so that a resumed simulation continues the same
+  # random sequence. A checkpoint that was interrupted while being appended
+  # is ignored, and the file is rewritten by the next checkpoint:
+  @classmethod
+  def from_checkpoint(cls, filename, restore_random_state=True):
+    import os
+    import pickle
+    with open(filename, "rb") as f:
+      size = os.fstat(f.fileno()).st_size
+      state = pickle.load(f)
+      mc = cls(state["scenario"])
+      complete = True
+      while True:
+        mc.runs.extend(state["runs"])
+        mc.raw_values.extend(state["raw_values"])
+        last = state
+        if f.tell() >= size:
+          break
+        try:
+          state = pickle.load(f)
+        except (EOFError, pickle.UnpicklingError):
+          complete = False
+          break
+    mc.summary = last["summary"]
+    if "histogram_data" in last:
+      mc.histogram_data = last["histogram_data"]
+    else:
+      mc.histogram_data.add(mc.raw_values)
+    mc.year_sketches = last.get("year_sketches", [])
+    if complete:
+      mc._checkpoint = (os.path.abspath(filename), len(mc.runs), len(mc.raw_values))
+    if restore_random_state:
+      np.random.set_state(last["random_state"])
+      mc.rng.bit_generator.state = last["rng_state"]
+    return mc
 
   def results(self, goal=None, remove_outliers=False):
+    strn = "Monte Carlo Results for the '" + self.scenario.name + "' Scenario:\n"
+    strn += "\n"
+    strn += "Number of Runs: " + str(self.summary.count) + "\n"
     if remove_outliers:
       self.values = _remove_outliers(self.raw_values)
+      strn += "High-end Outliers Removed: " + str(len(self.raw_values) - len(self.values)) + "\n"
+      strn += "\n"
+      strn += "Inflation Corrected Portfolio Final Values:\n"
+      strn += "  Average:   " + _format_currency(statistics.mean(self.values)) + "\n"
+      strn += "  Std Dev:   " + _format_currency(statistics.stdev(self.values)) + "\n"
+      strn += "\n"
+      strn += "  Median:    " + _format_currency(statistics.median_low(self.values)) + "\n"
+      strn += "  MAD:       " + _format_currency(astropy.stats.median_absolute_deviation(self.values)) + "\n"
+      strn += "\n"
+      strn += "  Minimum:   " + _format_currency(min(self.values)) + "\n"
+      strn += "  10th Perc: " + _format_currency(np.percentile(self.values, 10, interpolation='nearest')) + "\n"
+      strn += "  Median:    " + _format_currency(statistics.median_low(self.values)) + "\n"
+      strn += "  90th Perc: " + _format_currency(np.percentile(self.values, 90, interpolation='nearest')) + "\n"
+      strn += "  Maximum:   " + _format_currency(max(self.values)) + "\n"
     else:
+      # Without outlier removal, report the incrementally updated summary:
       self.values = self.raw_values
-    strn = "Monte Carlo Results for the '" + self.scenario.name + "' Scenario:\n"
-    strn += "\n"
-    strn += "Number of Runs: " + str(len(self.runs)) + "\n"
-    strn += "High-end Outliers Removed: " + str(len(self.raw_values) - len(self.values)) + "\n"
-    strn += "\n"
-    strn += "Inflation Corrected Portfolio Final Values:\n"
-    strn += "  Average:   " + _format_currency(statistics.mean(self.values)) + "\n"
-    strn += "  Std Dev:   " + _format_currency(statistics.stdev(self.values)) + "\n"
-    strn += "\n"
-    strn += "  Median:    " + _format_currency(statistics.median_low(self.values)) + "\n"
-    strn += "  MAD:       " + _format_currency(astropy.stats.median_absolute_deviation(self.values)) + "\n"
-    strn += "\n"
-    strn += "  Minimum:   " + _format_currency(min(self.values)) + "\n"
-    strn += "  10th Perc: " + _format_currency(np.percentile(self.values, 10, interpolation='nearest')) + "\n"
-    strn += "  Median:    " + _format_currency(statistics.median_low(self.values)) + "\n"
-    strn += "  90th Perc: " + _format_currency(np.percentile(self.values, 90, interpolation='nearest')) + "\n"
-    strn += "  Maximum:   " + _format_currency(max(self.values)) + "\n"
+      strn += "High-end Outliers Removed: 0\n"
+      strn += "\n"
+      strn += "Inflation Corrected Portfolio Final Values:\n"
+      strn += "  Average:   " + _format_currency(self.summary.mean) + "\n"
+      strn += "  Std Dev:   " + _format_currency(self.summary.std_dev()) + "\n"
+      strn += "\n"
+      strn += "  Median:    " + _format_currency(self.summary.median()) + "\n"
+      strn += "  MAD:       " + _format_currency(self.summary.mad()) + "\n"
+      strn += "\n"
+      strn += "  Minimum:   " + _format_currency(self.summary.min) + "\n"
+      strn += "  10th Perc: " + _format_currency(self.summary.percentile(10)) + "\n"
+      strn += "  Median:    " + _format_currency(self.summary.median()) + "\n"
+      strn += "  90th Perc: " + _format_currency(self.summary.percentile(90)) + "\n"
+      strn += "  Maximum:   " + _format_currency(self.summary.max) + "\n"
     strn += "\n"
     if goal != None:
-      good_runs = len([v for v in self.raw_values if v > goal])
+      # Goals are counted once and then tracked as more runs are added:
+      self.summary.track_goal(goal, self.raw_values)
       strn += "Savings Goal: " + _format_currency(goal) + "\n"
-      strn += "Likelihood of Meeting Goal: " + _format_percentage(good_runs/len(self.raw_values)) + "\n"
+      strn += "Likelihood of Meeting Goal: " + _format_percentage(self.summary.goal_probability(goal)) + "\n"
     return strn
 
-  def histogram(self, remove_outliers=True):
-    if remove_outliers:
-      self.values = _remove_outliers(self.raw_values)
-    else:
-      self.values = self.raw_values
-    import matplotlib.pyplot as plt
-    values = [v/1000000.0 for v in self.values]
-    weights = np.ones_like(values)/float(len(values))*100.0
-    plt.figure()
-    n, bins, patches = plt.hist(values, 30, weights=weights, facecolor='0.5', alpha=0.75)
-    plt.axvline(x=statistics.median_low(values), color='g')
-    plt.axvline(x=np.percentile(values, 10, interpolation='nearest'), color='r')
-    two_MAD = statistics.median_low(values) - 2*astropy.stats.median_absolute_deviation(values)
-    if two_MAD < 0.0:
-      two_MAD = 0.0
-    plt.axvline(x=two_MAD, color='m')
-    two_MAD = statistics.median_low(self.values) - 2*astropy.stats.median_absolute_deviation(self.values)
-    if two_MAD < 0.0:
-      two_MAD = 0.0
-    plt.legend([ \
-      'Median (' + _format_currency(statistics.median_low(self.values)) + ')', \
-      '10th Perc (' + _format_currency(np.percentile(self.values, 10, interpolation='nearest')) + ')', \
-      r'-2*MAD (' + _format_currency(two_MAD) + ')', \
-    ])
-    plt.xlabel('Portfolio Value ($M)')
-    plt.ylabel('Probability %')
-    plt.title('Final Portfolio Value Probability Distribution (n=' + str(len(self.runs)) + ")")
-    plt.grid(True)
+  # Estimate how much the likelihood of meeting the goal changes per bump
+  # of each parameter: the average return and the standard deviation of
+  # each position (matched by name across all phases), the annual
+  # contribution (of every phase) and the inflation rate. Each parameter is
+  # bumped up and down and the change is estimated by central finite
+  # differences. All bumped variants are simulated in one vectorized pass
+  # on the same random returns, so the estimates are not swamped by
+  # sampling noise. The changes are kept in self.sensitivities and a report
+  # is returned:
+  def sensitivity(self, goal, n=10000, seed=None, dtype=np.float64, return_bump_perc=1.0, std_dev_bump_perc=1.0, contribution_bump=1000.0, inflation_bump_perc=0.5):
+    assert not isinstance(self.scenario, Household_Scenario), "Sensitivity analysis isn't supported for household scenarios."
+    base = self.scenario._phases()
+    names = []
+    for phase in base:
+      names.extend([name for name in phase.position_names if name not in names])
+
+    # Build a bumped up and bumped down variant of the scenario for each parameter:
+    def bumped(field, amount, name=None):
+      phases = self.scenario._phases()
+      for phase in phases:
+        if name is None:
+          setattr(phase, field, getattr(phase, field) + amount)
+        else:
+          mask = np.array([n == name for n in phase.position_names])
+          setattr(phase, field, np.maximum(getattr(phase, field) + amount*mask, 0.0))
+      return phases
+
+    parameters = []
+    for name in names:
+      parameters.append((name + " Return +" + _format_percentage(return_bump_perc/100.0), "ave_returns", return_bump_perc/100.0, name))
+      parameters.append((name + " Std Dev +" + _format_percentage(std_dev_bump_perc/100.0), "std_devs", std_dev_bump_perc/100.0, name))
+    parameters.append(("Annual Contribution +" + _format_currency(contribution_bump), "contribution", contribution_bump, None))
+    parameters.append(("Inflation Rate +" + _format_percentage(inflation_bump_perc/100.0), "inflation_rate", inflation_bump_perc/100.0, None))
+
+    variants = [base]
+    for label, field, amount, name in parameters:
+      variants.extend([bumped(field, amount, name), bumped(field, -amount, name)])
+    values = _simulate_variants(self.scenario._initial_values(), variants, n, np.random.default_rng(seed), dtype)
+    probability = np.mean(values > goal, axis=1)
+
+    # Standard deviations can't go below zero, so scale the difference by
+    # the size of the bump that could actually be applied:
+    self.sensitivities = {}
+    for i, (label, field, amount, name) in enumerate(parameters):
+      up, down = variants[2*i + 1], variants[2*i + 2]
+      span = max(np.max(getattr(u, field) - getattr(d, field)) for u, d in zip(up, down))
+      self.sensitivities[label] = (probability[2*i + 1] - probability[2*i + 2])*amount/span if span > 0.0 else 0.0
+
+    template = "{0:<50}|{1:>10}"
+    strn = "Sensitivity of the '" + self.scenario.name + "' Scenario:\n"
+    strn += "\n"
+    strn += "Number of Runs: " + str(n) + "\n"
+    strn += "Savings Goal: " + _format_currency(goal) + "\n"
+    strn += "Likelihood of Meeting Goal: " + _format_percentage(probability[0]) + "\n"
+    strn += "\n"
+    strn += "-------------------------------------------------------------\n"
+    strn += template.format("Parameter", "Change ") + "\n"
+    strn += "-------------------------------------------------------------\n"
+    for label, change in self.sensitivities.items():
+      strn += template.format(label, ("+" if change >= 0.0 else "") + _format_percentage(change)) + "\n"
+    strn += "-------------------------------------------------------------\n"
+    return strn
 
-  def plot(self, smooth=False):
-    import matplotlib.pyplot as plt
+  # Compute the plot data of the simulation (see above), or return it from
+  # the cache if no runs were added since. The histogram is rebinned from
+  # the simulation's histogram into the given number of bins, and its
+  # statistics are estimated from the summary, so neither needs the final
+  # values. High outliers are removed as in results, but estimated from the
+  # summary. The series are downsampled to at most max_points points. For
+  # non-vectorized runs they are the runs with the median and 10th
+  # percentile final values, found with a partial sort. Vectorized runs
+  # aren't kept, so for those they are the median and 10th percentile of
+  # all runs in every year.
+  def plot_data(self, remove_outliers=True, bins=30, max_points=500):
+    key = (self.summary.count, remove_outliers, bins, max_points)
+    if self._plot_data_key == key:
+      return self._plot_data
+
+    sketch, threshold = self.summary.sketch, np.inf
+    if remove_outliers:
+      sketch, threshold = sketch.remove_outliers()
+    med = sketch.value_at_rank((sketch.count - 1)//2)
+    ten = sketch.value_at_rank(int(np.around(0.1*(sketch.count - 1))))
+    low = self.summary.min
+    high = self.summary.max if threshold == np.inf else sketch.value_at_rank(sketch.count - 1)
+    edges = np.linspace(low, high if high > low else low + 1.0, bins + 1)
+    histogram = self.histogram_data.rebin(edges, threshold)
+
+    series = []
+    if self.runs and len(self.runs) == len(self.raw_values):
+      raw_values = np.asarray(self.raw_values, dtype=np.float64)
+      # Only high outliers are removed, so the remaining values keep their
+      # rank among all values:
+      count = int(np.count_nonzero(raw_values < threshold))
+      ranks = [(count - 1)//2, int(np.around(0.1*(count - 1)))]
+      indices = np.argpartition(raw_values, ranks)[ranks]
+      for label, color, index in [('Median', 'lightblue', indices[0]), ('10th Perc', 'steelblue', indices[1])]:
+        history = self.runs[index].history
+        years = _downsample(len(history), max_points)
+        series.append((label, color, years, [history[year].value() for year in years], history[-1].value()))
+    elif self.year_sketches:
+      years = _downsample(len(self.year_sketches), max_points)
+      for label, color, perc in [('Median', 'lightblue', 0.5), ('10th Perc', 'steelblue', 0.1)]:
+        data = [self.year_sketches[year].value_at_rank(int(np.around(perc*(self.year_sketches[year].count - 1)))) for year in years]
+        series.append((label, color, years, data, data[-1]))
+
+    self._plot_data = Plot_Data(self.summary.count, histogram, med, ten, sketch.mad(), series)
+    self._plot_data_key = key
+    return self._plot_data
 
-    # Find the median and 10th percentile data sets:
-    med = statistics.median_low(self.values)
-    ten = np.percentile(self.values, 10, interpolation='nearest')
-    med_scenario = self.runs[self.raw_values.index(med)]
-    tenth_scenario = self.runs[self.raw_values.index(ten)]
+  def histogram(self, remove_outliers=True):
+    self.plot_data(remove_outliers).render_histogram()
 
-    # Plot the median and 10th percentile scenario:
-    f = plt.figure()
-    med_scenario.plot(figure=f, color='lightblue', label='Median', smooth=smooth)
-    tenth_scenario.plot(figure=f, color='steelblue', label='10th Perc', smooth=smooth)
+  def plot(self, smooth=False, remove_outliers=True):
+    self.plot_data(remove_outliers).render_plot(smooth)
 
 def show_plots():
   import matplotlib.pyplot as plt
   plt.show()
+
+#
+# Allocation optimizer:
+#
+# Searches for the start and end weights of a scenario's portfolio that
+# maximize the likelihood of meeting a goal, or that minimize the annual
+# contribution needed to meet a goal with a given likelihood. All
+# candidate allocations are evaluated on the same fixed set of random
+# returns (common random numbers), so differences between candidates are
+# due to their allocation and not to sampling noise.
+#
+# Because the scenario is rebalanced every year, the portfolio total after
+# a year is max(total + contribution, 0) times the weighted sum of the
+# (non-negative) growth of each position. The growth of every position is
+# drawn once, up front, so evaluating a candidate only requires the
+# weighted sum for each year, which is computed for a whole batch of
+# candidates with a single matrix multiplication.
+class Allocation_Optimizer(object):
+  def __init__(self, scenario, goal, n=10000, seed=None, dtype=np.float32, optimize_end_weights=None):
+    assert isinstance(scenario, Scenario), "Only a standard Scenario can be optimized."
+    assert scenario.rebalance, "Only scenarios with annual rebalancing can be optimized."
+    self.scenario = copy.deepcopy(scenario)
+    self.scenario.reset()
+    self.goal = float(goal)
+    self.n = int(n)
+    self.dtype = _dtype(dtype)
+    if optimize_end_weights is None:
+      optimize_end_weights = scenario.end_weights is not None
+    self.optimize_end_weights = optimize_end_weights
+
+    phase = self.scenario._phases()[0]
+    self.num_years = phase.num_years
+    self.initial_value = float(np.sum(self.scenario._initial_values()))
+    self.increases = (1.0 + phase.contribution_increase)**np.arange(1, self.num_years + 1)
+    self.discount = 1.0/(1.0 + phase.inflation_rate)**self.num_years
+
+    # Draw the growth of every position, for every year and run, once:
+    rng = np.random.default_rng(seed)
+    self.growth = rng.standard_normal((self.num_years, self.n, len(phase.ave_returns)), dtype=self.dtype)
+    self.growth *= phase.std_devs.astype(self.dtype)
+    self.growth += (1.0 + phase.ave_returns).astype(self.dtype)
+    np.maximum(self.growth, 0.0, out=self.growth)
+
+    # The scenario's own allocation and contribution:
+    self.start_weights = np.array(self.scenario.history[0].weights)
+    self.end_weights = np.array(scenario.end_weights if scenario.end_weights else self.start_weights, dtype=np.float64)
+    self.contribution = phase.contribution
+    self.likelihood = None
+
+  # Simulate the inflation corrected final value of every run for each
+  # candidate, returning an (n, candidates) array. Weights move exactly
+  # like Scenario's end_weights: linearly from the normalized start weights
+  # toward the end weights as given, renormalized every year:
+  def final_values(self, start_weights, end_weights=None, contribution=None):
+    start_weights = _normalize_weights(start_weights)
+    end_weights = start_weights if end_weights is None else _end_weights(end_weights)
+    contribution = np.broadcast_to(self.contribution if contribution is None else contribution, (len(start_weights),))
+    values = np.full((self.n, len(start_weights)), self.initial_value)
+    for x in range(self.num_years):
+      a = x/(self.num_years - 1) if self.num_years > 1 else 0.0
+      weights = (1.0 - a)*start_weights + a*end_weights
+      weights = (weights/weights.sum(axis=1, keepdims=True)).T.astype(self.dtype)
+      values += contribution*self.increases[x]
+      np.maximum(values, 0.0, out=values)
+      values *= self.growth[x] @ weights
+    return values*self.discount
+
+  # The likelihood of meeting the goal for each candidate:
+  def probability(self, start_weights, end_weights=None, contribution=None):
+    return np.mean(self.final_values(start_weights, end_weights, contribution) > self.goal, axis=0)
+
+  # The smallest annual contribution that meets the goal with the given
+  # likelihood for each candidate. With non-negative contributions no run
+  # is ever depleted, so every run's final value grows linearly with the
+  # contribution, and the contribution each run needs follows from two
+  # simulations. Candidates that meet the goal without contributing fall
+  # back to bisection over withdrawals (final values never decrease as the
+  # contribution increases), which brackets a guess of each candidate's
+  # contribution, the scenario's own by default, and stops within the
+  # given tolerance or relative tolerance:
+  def required_contribution(self, start_weights, end_weights=None, likelihood=0.9, tolerance=1.0, rel_tolerance=0.0, guess=None):
+    start_weights = _normalize_weights(start_weights)
+    end_weights = start_weights if end_weights is None else _end_weights(end_weights)
+    base = self.final_values(start_weights, end_weights, 0.0)
+    slope = self.final_values(start_weights, end_weights, 1.0) - base
+    with np.errstate(divide='ignore', invalid='ignore'):
+      needed = np.where(base > self.goal, -np.inf, np.where(slope > 0.0, (self.goal - base)/slope, np.inf))
+    rank = min(max(int(np.ceil(likelihood*self.n - 1e-9)), 1), self.n) - 1
+    # Final values must exceed the goal, so add half the tolerance:
+    contribution = np.partition(needed, rank, axis=0)[rank] + 0.5*tolerance
+    withdraws = contribution <= 0.0
+    if withdraws.any():
+      guess = np.broadcast_to(np.asarray(self.contribution if guess is None else guess, dtype=np.float64), contribution.shape)
+      contribution[withdraws] = self._bisect_contribution(start_weights[withdraws], end_weights[withdraws], likelihood, tolerance, rel_tolerance, np.minimum(guess[withdraws], 0.0))
+    return contribution
+
+  def _bisect_contribution(self, start_weights, end_weights, likelihood, tolerance, rel_tolerance, guess):
+    meets = lambda c: self.probability(start_weights, end_weights, c) >= likelihood
+    step = np.maximum(0.05*np.abs(guess), max(tolerance, 0.001*max(self.goal, self.initial_value, 1000.0)))
+    low, high = guess - step, guess + step
+    for x in range(60):
+      fails = ~meets(high)
+      if not fails.any():
+        break
+      low = np.where(fails, high, low)
+      high = np.where(fails, high + step, high)
+      step = np.where(fails, 2*step, step)
+    for x in range(60):
+      passes = meets(low)
+      if not passes.any():
+        break
+      high = np.where(passes, low, high)
+      low = np.where(passes, low - step, low)
+      step = np.where(passes, 2*step, step)
+    while np.any(high - low > np.maximum(tolerance, rel_tolerance*np.abs(high))):
+      middle = (low + high)/2.0
+      passes = meets(middle)
+      high = np.where(passes, middle, high)
+      low = np.where(passes, low, middle)
+    return high
+
+  # Search the weight space. Starting from the scenario's own allocation,
+  # single position allocations and random allocations, the best
+  # candidates are repeatedly perturbed with a shrinking step. The
+  # objective is either "likelihood" of meeting the goal, or
+  # "contribution" needed to meet the goal with the given likelihood. When
+  # that contribution is a withdrawal, each new candidate's is searched for
+  # near its parent's, to within 0.1% during the search and to within a
+  # dollar for the best:
+  def optimize(self, objective="likelihood", likelihood=0.9, rounds=40, candidates=64, keep=8, seed=None):
+    assert objective in ("likelihood", "contribution"), "Unknown objective: " + str(objective)
+    rng = np.random.default_rng(seed)
+    k = len(self.start_weights)
+
+    def score(starts, ends, guess=None):
+      if objective == "likelihood":
+        return self.probability(starts, ends)
+      return -self.required_contribution(starts, ends, likelihood, rel_tolerance=0.001, guess=guess)
+
+    def pairs(starts):
+      ends = rng.dirichlet(np.ones(k), len(starts)) if self.optimize_end_weights else starts
+      return starts, ends
+
+    starts = np.vstack([self.start_weights, np.eye(k), rng.dirichlet(np.ones(k), candidates)])
+    starts, ends = pairs(starts)
+    if self.optimize_end_weights:
+      ends[0] = self.end_weights
+    scores = score(starts, ends)
+
+    for r in range(rounds):
+      best = np.argsort(-scores, kind='stable')[:keep]
+      starts, ends, scores = starts[best], ends[best], scores[best]
+      step = 0.5*(1.0 - r/float(rounds)) + 0.02
+      parents = rng.integers(0, len(starts), candidates)
+      new_starts = (1.0 - step)*starts[parents] + step*rng.dirichlet(np.full(k, 0.5), candidates)
+      new_ends = new_starts
+      if self.optimize_end_weights:
+        new_ends = (1.0 - step)*ends[parents] + step*rng.dirichlet(np.full(k, 0.5), candidates)
+      new_scores = score(new_starts, new_ends, -scores[parents])
+      starts, ends, scores = np.vstack([starts, new_starts]), np.vstack([ends, new_ends]), np.concatenate([scores, new_scores])
+
+    best = int(np.argmax(scores))
+    self.start_weights, self.end_weights = starts[best], ends[best]
+    if objective == "contribution":
+      self.contribution = float(self.required_contribution(self.start_weights[np.newaxis], self.end_weights[np.newaxis], likelihood, guess=-scores[best])[0])
+    self.likelihood = float(self.probability(self.start_weights[np.newaxis], self.end_weights[np.newaxis])[0])
+    return self
+
+  # Return a copy of the scenario using the optimized allocation and contribution:
+  def optimized_scenario(self):
+    scenario = copy.deepcopy(self.scenario)
+    portfolio = copy.deepcopy(scenario.history[0])
+    portfolio.trade(-portfolio.value())
+    portfolio.set_weights(list(self.start_weights))
+    portfolio.trade(self.initial_value)
+    end_weights = list(self.end_weights) if self.optimize_end_weights else None
+    return Scenario(scenario.name, portfolio, scenario.num_years, scenario.inflation_rate*100.0, scenario.rebalance, \
+      self.contribution, scenario.addition_increase*100.0, end_weights)
+
+  def results(self):
+    template = "{0:<30}|{1:>12}|{2:>12}"
+    strn = "Optimized Allocation for the '" + self.scenario.name + "' Scenario:\n"
+    strn += "\n"
+    strn += "-----------------------------------------------------------\n"
+    strn += template.format("Position", "Start ", "End ") + "\n"
+    strn += "-----------------------------------------------------------\n"
+    end_weights = _normalize_weights(self.end_weights)[0]
+    for p, w_start, w_end in zip(self.scenario.history[0].positions, self.start_weights, end_weights):
+      strn += template.format(p.name, _format_percentage(w_start), _format_percentage(w_end)) + "\n"
+    strn += "-----------------------------------------------------------\n"
+    strn += "\n"
+    strn += "Annual Contribution: " + _format_currency(self.contribution) + "\n"
+    strn += "Savings Goal: " + _format_currency(self.goal) + "\n"
+    if self.likelihood is not None:
+      strn += "Likelihood of Meeting Goal: " + _format_percentage(self.likelihood) + "\n"
+    return strn
+
+def _normalize_weights(weights):
+  weights = np.atleast_2d(np.asarray(weights, dtype=np.float64))
+  assert (weights >= 0.0).all(), "All weights must be positive."
+  return weights/weights.sum(axis=1, keepdims=True)
+
+# End weights are kept as given, since Scenario only renormalizes the
+# yearly mix with the start weights:
+def _end_weights(weights):
+  weights = np.atleast_2d(np.asarray(weights, dtype=np.float64))
+  assert (weights >= 0.0).all(), "All weights must be positive."
+  return weights
+
+#
+# Declarative scenario definitions:
+#
+# Scenarios can be described as plain dictionaries (usually loaded from
+# JSON or TOML files) so that they can be run in batch without writing a
+# script. A position is either the name of one of the predefined positions
+# above (ie. "US_Stocks") or a dictionary with "name", "ave_return",
+# "std_dev" and an optional "value". A portfolio is a dictionary with
+# "name", "positions", "weights" and an optional "value". A scenario is a
+# dictionary with a "type" of "scenario" (the default) or "piecewise":
+#
+#   {"type": "scenario", "name": "College", "num_years": 18,
+#    "portfolio": {"name": "529", "value": 5000, "positions": ["US_Stocks", "US_Bonds"], "weights": [1, 0]},
+#    "annual_contribution": 2500, "inflation_rate_perc": 2.5, "end_weights": [0, 1]}
+#
+#   {"type": "piecewise", "name": "Retirement Plan", "scenarios": [{...}, {...}]}
+#
+# All other keys of a standard scenario map directly to the arguments of
+# the Scenario class. A "household" scenario holds a "household"
+# dictionary with a list of "accounts" (each with a "portfolio", and an
+# optional "kind", "annual_contribution" and "cost_basis") and the other
+# arguments of the Household class, while its other keys map to the
+# arguments of the Household_Scenario class.
+# The predefined positions (see above) that can be named in a job:
+_predefined_positions = {
+  "US_Stocks": US_Stocks,
+  "International_Stocks": International_Stocks,
+  "US_Bonds": US_Bonds,
+  "International_Bonds": International_Bonds,
+  "Alternatives": Alternatives,
+  "Cash": Cash,
+  "Large_Cap_Stocks": Large_Cap_Stocks,
+  "Small_Cap_Stocks": Small_Cap_Stocks,
+  "Long_Term_Corp_Bonds": Long_Term_Corp_Bonds,
+  "Long_Term_Gov_Bonds": Long_Term_Gov_Bonds,
+  "US_Treasury_Bills": US_Treasury_Bills,
+  "US_Large_Cap_Growth_Stocks": US_Large_Cap_Growth_Stocks,
+  "US_Large_Cap_Value_Stocks": US_Large_Cap_Value_Stocks,
+  "US_Mid_Cap_Growth_Stocks": US_Mid_Cap_Growth_Stocks,
+  "US_Mid_Cap_Value_Stocks": US_Mid_Cap_Value_Stocks,
+  "US_Small_Cap_Growth_Stocks": US_Small_Cap_Growth_Stocks,
+  "US_Small_Cap_Value_Stocks": US_Small_Cap_Value_Stocks,
+  "International_Dev_Stocks": International_Dev_Stocks,
+  "International_Emrg_Stocks": International_Emrg_Stocks,
+  "US_Investment_Grd_Bonds": US_Investment_Grd_Bonds,
+  "US_High_Yield_Bonds": US_High_Yield_Bonds,
+  "International_Dev_Bonds": International_Dev_Bonds,
+  "Three_Mon_Treasury_Bills": Three_Mon_Treasury_Bills,
+  "Commodities": Commodities,
+  "US_Real_Estate": US_Real_Estate,
+}
+
+def position_from_dict(spec):
+  if isinstance(spec, str):
+    assert spec in _predefined_positions, "Unknown predefined position: " + spec
+    return _predefined_positions[spec]()
+  return Position(spec["name"], spec["ave_return"], spec["std_dev"], spec.get("value", 0.0))
+
+def portfolio_from_dict(spec):
+  positions = [position_from_dict(p) for p in spec["positions"]]
+  return Portfolio(spec.get("name", "Portfolio"), positions, spec["weights"], spec.get("value", 0.0))
+
+_scenario_keys = ["inflation_rate_perc", "rebalance", "annual_contribution", "annual_contribution_increase_perc", "end_weights"]
+_household_keys = ["withdrawal_order", "income_tax_rate_perc", "capital_gains_tax_rate_perc"]
+_household_scenario_keys = ["annual_spending", "annual_spending_increase_perc", "annual_contribution_increase_perc", "transfers", "inflation_rate_perc", "rebalance"]
+
+def scenario_from_dict(spec):
+  kind = spec.get("type", "scenario")
+  if kind == "piecewise":
+    scenarios = [scenario_from_dict(s) for s in spec["scenarios"]]
+    return Piecewise_Scenario(spec.get("name", "Piecewise"), scenarios)
+  if kind == "household":
+    household = spec["household"]
+    accounts = [Account(portfolio_from_dict(a["portfolio"]), a.get("kind", "taxable"), a.get("annual_contribution", 0.0), a.get("cost_basis")) for a in household["accounts"]]
+    household_kwargs = {key: household[key] for key in _household_keys if key in household}
+    kwargs = {key: spec[key] for key in _household_scenario_keys if key in spec}
+    return Household_Scenario(spec.get("name", "Household"), Household(household.get("name", "Household"), accounts, **household_kwargs), spec["num_years"], **kwargs)
+  assert kind == "scenario", "Unknown scenario type: " + str(kind)
+  kwargs = {key: spec[key] for key in _scenario_keys if key in spec}
+  return Scenario(spec.get("name", "Scenario"), portfolio_from_dict(spec["portfolio"]), spec["num_years"], **kwargs)
+
+#
+# Batch runner:
+#
+# A job is a dictionary holding a "scenario" definition (see above) along
+# with the number of Monte Carlo runs "n", and an optional random "seed"
+# and savings "goal". Setting "vectorized" to true runs the job with the
+# vectorized engine, in the optional "dtype" ("float64" or "float32"). A job file contains either a single job or a list of
+# jobs under the "jobs" key (or as a top level JSON list). Jobs are run
+# across a pool of processes and the results can be written as JSON, CSV
+# or NPZ. Nothing here imports matplotlib.
+def load_jobs(filename):
+  if filename.endswith(".toml"):
+    try:
+      import tomllib
+    except ImportError:
+      import tomli as tomllib
+    with open(filename, "rb") as f:
+      data = tomllib.load(f)
+  else:
+    with open(filename, "r") as f:
+      data = json.load(f)
+  if isinstance(data, dict) and "jobs" in data:
+    data = data["jobs"]
+  jobs = data if isinstance(data, list) else [data]
+  for job in jobs:
+    assert "scenario" in job, "Job in '" + filename + "' is missing a 'scenario' definition."
+    job.setdefault("name", job["scenario"].get("name", "Scenario"))
+  return jobs
+
+def _summarize(values, goal=None):
+  summary = {
+    "runs": len(values),
+    "mean": statistics.mean(values),
+    "std_dev": statistics.stdev(values) if len(values) > 1 else 0.0,
+    "median": statistics.median_low(values),
+    "mad": float(astropy.stats.median_absolute_deviation(values)),
+    "min": min(values),
+    "perc_10": float(np.percentile(values, 10, method='nearest')),
+    "perc_90": float(np.percentile(values, 90, method='nearest')),
+    "max": max(values),
+  }
+  if goal is not None:
+    summary["goal"] = float(goal)
+    summary["goal_probability"] = len([v for v in values if v > goal])/len(values)
+  return summary
+
+def _run_monte_carlo(job):
+  # Seed every job explicitly, otherwise forked workers would all share
+  # the same random state:
+  np.random.seed(job.get("seed"))
+  mc = Monte_Carlo(scenario_from_dict(job["scenario"]), seed=job.get("seed"))
+  mc.run(n=int(job.get("n", 400)), vectorized=job.get("vectorized", False), dtype=job.get("dtype", "float64"))
+  return mc
+
+def run_job(job):
+  mc = _run_monte_carlo(job)
+  return {
+    "name": job["name"],
+    "n": len(mc.raw_values),
+    "seed": job.get("seed"),
+    "summary": _summarize(mc.raw_values, job.get("goal")),
+    "values": mc.raw_values.tolist(),
+  }
+
+def run_jobs(jobs, processes=None):
+  import concurrent.futures
+  if processes == 1 or len(jobs) == 1:
+    return [run_job(job) for job in jobs]
+  with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+    return list(executor.map(run_job, jobs))
+
+def write_results(results, filename, format=None):
+  format = format or filename.rsplit(".", 1)[-1].lower()
+  if format == "json":
+    with open(filename, "w") as f:
+      json.dump(results, f, indent=2)
+  elif format == "csv":
+    import csv
+    fields = ["name", "n", "seed"] + sorted(set(k for r in results for k in r["summary"]))
+    with open(filename, "w", newline="") as f:
+      writer = csv.DictWriter(f, fieldnames=fields)
+      writer.writeheader()
+      for r in results:
+        row = {"name": r["name"], "n": r["n"], "seed": r["seed"]}
+        row.update(r["summary"])
+        writer.writerow(row)
+  elif format == "npz":
+    arrays = {"names": np.array([r["name"] for r in results])}
+    for i, r in enumerate(results):
+      arrays["values_" + str(i)] = np.asarray(r["values"])
+    for key in sorted(set(k for r in results for k in r["summary"])):
+      arrays[key] = np.array([r["summary"].get(key, np.nan) for r in results], dtype=float)
+    np.savez(filename, **arrays)
+  else:
+    assert False, "Unknown output format: " + str(format)
+
+#
+# Simulation server:
+#
+# A small asyncio HTTP server that runs jobs (see above) on request. POST a
+# job as JSON to /simulate and the response streams newline delimited JSON
+# events: a "progress" event, including the summary of the runs completed
+# so far, after each chunk of runs finishes, followed by a final "result"
+# event. Concurrent requests that share the same scenario are coalesced into
+# a single batched simulation: each request receives the shared runs
+# summarized against its own goal. Seeded requests are only coalesced with
+# requests of the same seed and number of runs, so that they always return
+# the same runs. Runs are executed in chunks across a process pool so the
+# event loop is never blocked. Each chunk is summarized by its worker and
+# merged into a running Monte_Carlo_Summary of the batch, so events don't
+# rescan the runs, and their median, percentiles and MAD come from its
+# quantile sketch. The server only listens on localhost by default.
+def _run_chunk(job):
+  mc = _run_monte_carlo(job)
+  return mc.summary, np.frombuffer(mc.raw_values)
+
+class _Simulation_Batch(object):
+  def __init__(self, job, n):
+    self.job = job
+    self.n = n
+    self.summary = Monte_Carlo_Summary()
+    # The runs are only kept to count them against the goals of requests
+    # that join the batch after it started:
+    self.values = array.array('d')
+    self.started = False
+    self.done = False
+    self.subscribers = []
+    self.task = None
+
+class Simulation_Server(object):
+  def __init__(self, host="127.0.0.1", port=8765, processes=None, chunk_size=100, batch_window=0.05, vectorized_chunk_size=100000):
+    self.host = host
+    self.port = int(port)
+    self.processes = processes
+    self.chunk_size = int(chunk_size)
+    self.vectorized_chunk_size = int(vectorized_chunk_size)
+    self.batch_window = float(batch_window)
+    self.batches = {}
+    self.executor = None
+    self.server = None
+
+  async def start(self):
+    import asyncio
+    import concurrent.futures
+    import multiprocessing
+    import os
+    # Workers that are forked while a connection is open would inherit its
+    # socket and keep it open, so they are started from a fork server where
+    # available, and all of them are started before accepting connections:
+    context = None
+    if "forkserver" in multiprocessing.get_all_start_methods():
+      context = multiprocessing.get_context("forkserver")
+    processes = self.processes or os.cpu_count() or 1
+    self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=processes, mp_context=context)
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*[loop.run_in_executor(self.executor, os.getpid) for i in range(processes)])
+    self.server = await asyncio.start_server(self._handle, self.host, self.port)
+    self.port = self.server.sockets[0].getsockname()[1]
+
+  async def stop(self):
+    self.server.close()
+    await self.server.wait_closed()
+    self.executor.shutdown(cancel_futures=True)
+
+  async def serve_forever(self):
+    await self.start()
+    print("Serving stocker simulations on http://" + self.host + ":" + str(self.port) + "/simulate")
+    try:
+      await self.server.serve_forever()
+    finally:
+      self.executor.shutdown(cancel_futures=True)
+
+  # Subscribe to a batch sharing this job's scenario, creating a new
+  # batch if no compatible one is pending or running:
+  def _subscribe(self, job, queue):
+    import asyncio
+    n = int(job.get("n", 400))
+    seed = job.get("seed")
+    key = json.dumps([job["scenario"], seed, n if seed is not None else None, job.get("vectorized", False), job.get("dtype", "float64")], sort_keys=True)
+    batch = self.batches.get(key)
+    if batch is None or (batch.started and batch.n < n):
+      batch = _Simulation_Batch(job, n)
+      self.batches[key] = batch
+      asyncio.get_running_loop().call_later(self.batch_window, self._start_batch, key, batch)
+    batch.n = max(batch.n, n)
+    if job.get("goal") is not None:
+      batch.summary.track_goal(job["goal"], batch.values)
+    batch.subscribers.append((job, queue))
+
+  def _start_batch(self, key, batch):
+    import asyncio
+    # Keep a reference to the task, the event loop only keeps a weak one:
+    batch.task = asyncio.ensure_future(self._run_batch(key, batch))
+
+  async def _run_batch(self, key, batch):
+    import asyncio
+    batch.started = True
+    loop = asyncio.get_running_loop()
+    # Households always run on the vectorized engine:
+    vectorized = batch.job.get("vectorized", False) or batch.job["scenario"].get("type") == "household"
+    chunk_size = self.vectorized_chunk_size if vectorized else self.chunk_size
+    sizes = [min(chunk_size, batch.n - start) for start in range(0, batch.n, chunk_size)]
+    seeds = [None]*len(sizes)
+    if batch.job.get("seed") is not None:
+      seeds = [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(batch.job["seed"]).spawn(len(sizes))]
+    futures = [loop.run_in_executor(self.executor, _run_chunk, dict(batch.job, n=size, seed=seed)) for size, seed in zip(sizes, seeds)]
+    try:
+      for future in asyncio.as_completed(futures):
+        summary, values = await future
+        for goal in batch.summary.goals:
+          summary.track_goal(goal, values)
+        batch.summary.merge(summary)
+        batch.values.frombytes(values.tobytes())
+        self._publish("progress", batch)
+      self._publish("result", batch)
+    except Exception as e:
+      for job, queue in batch.subscribers:
+        queue.put_nowait({"event": "error", "name": job["name"], "error": str(e)})
+    finally:
+      batch.done = True
+      if self.batches.get(key) is batch:
+        del self.batches[key]
+      for job, queue in batch.subscribers:
+        queue.put_nowait(None)
+
+  # Send an event to every subscriber of the batch. Only the likelihood of
+  # meeting the goal differs between subscribers:
+  def _publish(self, kind, batch):
+    summary = batch.summary
+    shared = {
+      "runs": summary.count,
+      "mean": summary.mean,
+      "std_dev": summary.std_dev() if summary.count > 1 else 0.0,
+      "median": summary.median(),
+      "mad": summary.mad(),
+      "min": summary.min,
+      "perc_10": summary.percentile(10),
+      "perc_90": summary.percentile(90),
+      "max": summary.max,
+    }
+    for job, queue in batch.subscribers:
+      event_summary = dict(shared)
+      if job.get("goal") is not None:
+        event_summary["goal"] = float(job["goal"])
+        event_summary["goal_probability"] = summary.goal_probability(job["goal"])
+      queue.put_nowait({
+        "event": kind,
+        "name": job["name"],
+        "completed": summary.count,
+        "total": batch.n,
+        "coalesced": len(batch.subscribers),
+        "summary": event_summary,
+      })
+
+  async def _handle(self, reader, writer):
+    import asyncio
+    try:
+      request_line = (await reader.readline()).decode("latin-1").split()
+      headers = {}
+      while True:
+        line = (await reader.readline()).decode("latin-1").strip()
+        if not line:
+          break
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+      body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+      if len(request_line) < 2 or request_line[1] != "/simulate":
+        return await self._respond(writer, "404 Not Found", {"error": "Unknown path, POST jobs to /simulate"})
+      if request_line[0] != "POST":
+        return await self._respond(writer, "405 Method Not Allowed", {"error": "POST jobs to /simulate"})
+      try:
+        job = json.loads(body.decode("utf-8"))
+        assert isinstance(job, dict) and "scenario" in job, "Job is missing a 'scenario' definition."
+        job.setdefault("name", job["scenario"].get("name", "Scenario"))
+        assert int(job.get("n", 400)) > 0, "The number of runs must be positive."
+        scenario_from_dict(job["scenario"])
+      except Exception as e:
+        return await self._respond(writer, "400 Bad Request", {"error": str(e)})
+
+      queue = asyncio.Queue()
+      self._subscribe(job, queue)
+      writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\nConnection: close\r\n\r\n")
+      while True:
+        event = await queue.get()
+        if event is None:
+          break
+        data = (json.dumps(event) + "\n").encode("utf-8")
+        writer.write(("%x\r\n" % len(data)).encode("latin-1") + data + b"\r\n")
+        await writer.drain()
+      writer.write(b"0\r\n\r\n")
+      await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+      pass
+    finally:
+      writer.close()
+
+  async def _respond(self, writer, status, content):
+    data = json.dumps(content).encode("utf-8")
+    writer.write(("HTTP/1.1 " + status + "\r\nContent-Type: application/json\r\nContent-Length: " + str(len(data)) + "\r\nConnection: close\r\n\r\n").encode("latin-1") + data)
+    await writer.drain()
+
+def serve(host="127.0.0.1", port=8765, processes=None, chunk_size=100, batch_window=0.05, vectorized_chunk_size=100000):
+  import asyncio
+  server = Simulation_Server(host, port, processes, chunk_size, batch_window, vectorized_chunk_size)
+  try:
+    asyncio.run(server.serve_forever())
+  except KeyboardInterrupt:
+    pass
+
+def main(argv=None):
+  import argparse
+  parser = argparse.ArgumentParser(prog="python -m stocker", description="Run Monte Carlo simulations of scenario files in batch.")
+  parser.add_argument("files", nargs="*", help="JSON or TOML job files")
+  parser.add_argument("-o", "--output", default=None, help="output file (.json, .csv or .npz), prints a summary if omitted")
+  parser.add_argument("-f", "--format", choices=["json", "csv", "npz"], default=None, help="output format, inferred from the output file extension by default")
+  parser.add_argument("-j", "--processes", type=int, default=None, help="number of worker processes (default: number of CPUs)")
+  parser.add_argument("-n", type=int, default=None, help="override the number of runs of every job")
+  parser.add_argument("--seed", type=int, default=None, help="base seed, job i without a seed is given seed + i")
+  parser.add_argument("--serve", action="store_true", help="run the simulation server instead of job files")
+  parser.add_argument("--host", default="127.0.0.1", help="server host (default: %(default)s)")
+  parser.add_argument("--port", type=int, default=8765, help="server port (default: %(default)s)")
+  args = parser.parse_args(argv)
+
+  if args.serve:
+    return serve(args.host, args.port, args.processes)
+  if not args.files:
+    parser.error("job files are required unless --serve is given")
+
+  jobs = [job for filename in args.files for job in load_jobs(filename)]
+  for i, job in enumerate(jobs):
+    if args.n is not None:
+      job["n"] = args.n
+    if args.seed is not None and job.get("seed") is None:
+      job["seed"] = args.seed + i
+
+  results = run_jobs(jobs, args.processes)
+  if args.output:
+    write_results(results, args.output, args.format)
+  else:
+    for r in results:
+      strn = r["name"] + ": " + str(r["n"]) + " runs, median " + _format_currency(r["summary"]["median"])
+      if "goal_probability" in r["summary"]:
+        strn += ", likelihood of meeting goal " + _format_percentage(r["summary"]["goal_probability"])
+      print(strn)
+
+if __name__ == "__main__":
+  main()